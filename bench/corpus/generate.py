@@ -0,0 +1,152 @@
+# Regenerates the benchmark corpus next to this file. The pages are checked
+# in, so this only needs running to change them; output is deterministic.
+import os
+import random
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORDS = ("browser layout style render parse token element canvas frame widget script timer "
+         "paint flow line word font measure cache stream chunk network request page").split()
+
+
+def sentence(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count)).capitalize() + "."
+
+
+def large_text(rng):
+    parts = ["<html><head><title>Large text</title></head><body><h1>Large text</h1>"]
+    for section in range(60):
+        parts.append(f"<h2>Section {section}</h2>")
+        for _ in range(50):
+            parts.append(f"<p>{sentence(rng, 12)} <b>{sentence(rng, 3)}</b> {sentence(rng, 8)}</p>")
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def nested_divs(rng):
+    parts = ["<html><head><title>Nested divs</title>",
+             "<style>div { color: black; } div div { font-size: 11px; } div > p { color: navy; } .leaf { font-weight: bold; }</style>",
+             "</head><body>"]
+    for block in range(40):
+        depth = 60
+        parts.append("".join(f'<div class="level{level % 10}">' for level in range(depth)))
+        parts.append(f'<p class="leaf">{sentence(rng, 6)}</p>')
+        parts.append("</div>" * depth)
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def big_stylesheet(rng):
+    rules = ["/* A stylesheet the size of a real site's, with comments, lists and at-rules */"]
+    for i in range(3000):
+        kind = i % 6
+        color = f"#{rng.randrange(0x1000000):06x}"
+        if kind == 0:
+            rules.append(f".c{i} {{ color: {color}; }}")
+        elif kind == 1:
+            rules.append(f"div .c{i} > p {{ font-size: {10 + i % 8}px; }}")
+        elif kind == 2:
+            rules.append(f"#id{i}, .c{i} span {{ background-color: {color}; }}")
+        elif kind == 3:
+            rules.append(f"ul li.c{i} a[title] {{ font-weight: bold; }}")
+        elif kind == 4:
+            rules.append(f"@media screen and (min-width: {400 + i % 800}px) {{ .c{i} {{ color: {color}; }} }}")
+        else:
+            rules.append(f'.c{i}::before {{ content: "{{;}}"; }} p.c{i} {{ text-transform: uppercase; }}')
+    parts = ["<html><head><title>Big stylesheet</title><style>", "\n".join(rules), "</style></head><body>"]
+    for i in range(2000):
+        cls = f"c{rng.randrange(3000)}"
+        parts.append(f'<div class="{cls} row"><p class="{cls}"><span>{sentence(rng, 4)}</span></p></div>')
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def dino():
+    # A Dino-style game: a setInterval loop moving obstacles and redrawing
+    # the board and score through innerText every frame
+    return """<html><head><title>Dino</title>
+<style>
+body { background-color: white; }
+#board { color: green; font-size: 12px; }
+#score { font-weight: bold; }
+</style></head>
+<body>
+<h1>PyBrowser Dino</h1>
+<p id="score">Score: 0</p>
+<div id="board">loading</div>
+<p id="status">running</p>
+<button id="jump" onclick="jump()">Jump</button>
+<script>
+let score = 0;
+let width = 40;
+let height = 0;
+let speed = 1;
+let obstacles = new Array(40).fill(0);
+let alive = 1;
+function jump() {
+    if (height == 0) {
+        height = 3;
+    }
+}
+function draw() {
+    let out = "";
+    for (let i = 0; i < width; i++) {
+        if (i == 2 && height > 0) {
+            out = out + "^";
+        } else if (i == 2) {
+            out = out + "@";
+        } else if (obstacles[i] == 1) {
+            out = out + "#";
+        } else {
+            out = out + "_";
+        }
+    }
+    document.getElementById("board").innerText = out;
+    document.getElementById("score").innerText = "Score: " + score;
+}
+function tick() {
+    for (let i = 0; i < width - 1; i++) {
+        obstacles[i] = obstacles[i + 1];
+    }
+    if (score % 7 == 0) {
+        obstacles[width - 1] = 1;
+    } else {
+        obstacles[width - 1] = 0;
+    }
+    if (obstacles[2] == 1 && height == 0) {
+        jump();
+    }
+    if (height > 0) {
+        height--;
+    }
+    score++;
+    draw();
+}
+setInterval(function() {
+    tick();
+}, 16);
+document.addEventListener('keydown', function(event) {
+    if (event.keyCode == 32) {
+        jump();
+    }
+}, false);
+draw();
+</script>
+</body></html>
+"""
+
+
+def main():
+    rng = random.Random(20240601)
+    pages = {
+        "large_text.html": large_text(rng),
+        "nested_divs.html": nested_divs(rng),
+        "big_stylesheet.html": big_stylesheet(rng),
+        "dino.html": dino(),
+    }
+    for name, html in pages.items():
+        with open(os.path.join(HERE, name), "w", encoding="utf-8") as f:
+            f.write(html)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# Benchmarks the browser's pipeline stage by stage over the pages in corpus/
+#
+#   python bench/run.py                    run, and compare with baseline.json
+#   python bench/run.py --save-baseline    run, and store the results as the baseline
+#   xvfb-run python bench/run.py --backend tk
+#
+# Stages, each timed on its own for every page:
+#   parse   AdvancedCSSRenderer.feed + close, scripts deferred as elements
+#   style   AdvancedCSSRenderer.restyle: every element's style from cold rules
+#   js      the page's scripts through SimpleJSInterpreter.run
+#   render  RenderCSS into a frame: null widgets headless, real ones with Tk
+#   layout  DocumentLayout.flow at 800px with ApproxMetrics
+#   frames  FRAMES rounds of the page's setInterval callbacks, if it has any
+#
+# The baseline is specific to the machine and Python it was made on; save
+# a new one before comparing runs somewhere else, on an otherwise idle
+# machine. The fastest of --repeat runs is what's compared. The baseline
+# also records how far apart its runs were for each stage, and a stage
+# only counts as regressed past that spread as well as --threshold, the
+# spread counting for at most MAX_SPREAD.
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import main
+
+CORPUS = os.path.join(HERE, "corpus")
+BASELINE = os.path.join(HERE, "baseline.json")
+STAGES = ("parse", "style", "js", "render", "layout", "frames")
+FRAMES = 200
+MAX_SPREAD = 1.75  # so a noisy baseline can't hide a real slowdown
+WIDTH = 800
+
+
+# ================== STAGES ==================
+def RunScripts(cssrenderer):
+    elements = cssrenderer.htmlCollection.elements
+    for element in [element for element in elements if element.type == "script"]:
+        cssrenderer.runScript(element, elements.index(element))
+    cssrenderer.js.loop.flush()
+
+
+def RunFrames(cssrenderer):
+    # Calls the interval timers straight away instead of waiting them out,
+    # applying the DOM writes after each round as a tick would
+    loop = cssrenderer.js.loop
+    intervals = [(timer[0], timer[1]) for timer in loop.timers.values() if timer[2] is not None]
+    if not intervals:
+        return False
+    for _ in range(FRAMES):
+        for func, args in intervals:
+            loop.run_callback(func, args)
+        loop.flush()
+    return True
+
+
+def Settle(visualSystem):
+    # With Tk, counts the geometry work widgets queue up as part of the stage
+    if isinstance(visualSystem.root, main.tk.Misc):
+        visualSystem.root.update_idletasks()
+
+
+def BenchPage(html, visualSystem):
+    # One pass over a page from cold caches; returns {stage: ms}. The
+    # collector is kept out of the timings, which it would otherwise land
+    # in at random.
+    times = {}
+    main.Stylesheets.clear()
+    main.SimpleJSInterpreter.compiled_cache.clear()
+    main.SimpleJSInterpreter.expression_cache.clear()
+    cssrenderer = main.AdvancedCSSRenderer(visualSystem)
+    visualSystem.page = cssrenderer
+    cssrenderer.deferScripts = True
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        cssrenderer.feed(html)
+        cssrenderer.close()
+        times["parse"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        cssrenderer.restyle()
+        times["style"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        RunScripts(cssrenderer)
+        times["js"] = time.perf_counter() - started
+
+        frame = visualSystem.Frame()
+        started = time.perf_counter()
+        main.RenderCSS(cssrenderer, frame, visualSystem)
+        Settle(visualSystem)
+        times["render"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        main.DocumentLayout(cssrenderer, main.ApproxMetrics()).flow(WIDTH)
+        times["layout"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if RunFrames(cssrenderer):
+            Settle(visualSystem)
+            times["frames"] = time.perf_counter() - started
+        frame.destroy()
+    finally:
+        cssrenderer.teardown()
+        gc.enable()
+    return {stage: seconds * 1000 for stage, seconds in times.items()}
+
+
+# ================== HARNESS ==================
+def MakeVisualSystem(backend):
+    if backend == "tk":
+        root = main.tk.Tk()
+        root.geometry(f"{WIDTH}x600")
+        return main.VISUALSYSTEM(root)
+    visualSystem = main.NullVisualSystem(width=WIDTH)
+    visualSystem.backend = "widgets"  # RenderCSS draws into the null widgets
+    return visualSystem
+
+
+def RunCorpus(pages, repeat, backend):
+    # The fastest time for each page and stage, and the slowest run over it
+    visualSystem = MakeVisualSystem(backend)
+    results = {}
+    spread = {}
+    try:
+        for name in pages:
+            with open(os.path.join(CORPUS, name), encoding="utf-8") as f:
+                html = f.read()
+            # An untimed pass first takes the process's one-off costs; the
+            # caches are still cleared for every timed run
+            BenchPage(html, visualSystem)
+            runs = [BenchPage(html, visualSystem) for _ in range(repeat)]
+            stages = [stage for stage in STAGES if stage in runs[0]]
+            results[name] = {stage: round(min(run[stage] for run in runs), 3) for stage in stages}
+            spread[name] = {stage: round(max(run[stage] for run in runs) / max(results[name][stage], 0.001), 3)
+                            for stage in stages}
+            sys.stderr.write(f"{name}: {results[name]}\n")
+    finally:
+        if backend == "tk":
+            visualSystem.root.destroy()
+    return results, spread
+
+
+def Machine(backend):
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "backend": backend,
+    }
+
+
+def Compare(results, baseline, spread, threshold):
+    # Report lines and whether any stage got slower than threshold times
+    # its baseline, and than the baseline's own runs were apart. Stages
+    # under a millisecond are too noisy to judge.
+    lines = [f"{'page':<22}{'stage':<8}{'ms':>10}{'baseline':>10}{'ratio':>8}"]
+    regressed = False
+    for name, stages in results.items():
+        for stage, ms in stages.items():
+            before = baseline.get(name, {}).get(stage)
+            if before is None:
+                lines.append(f"{name:<22}{stage:<8}{ms:>10.2f}{'-':>10}{'-':>8}")
+                continue
+            ratio = ms / before if before else 1.0
+            limit = max(threshold, min(spread.get(name, {}).get(stage, 1.0), MAX_SPREAD))
+            slow = ratio > limit and ms - before >= 1
+            regressed = regressed or slow
+            lines.append(f"{name:<22}{stage:<8}{ms:>10.2f}{before:>10.2f}{ratio:>8.2f}" + ("  REGRESSED" if slow else ""))
+    return lines, regressed
+
+
+def Main(argv):
+    parser = argparse.ArgumentParser(prog="bench/run.py", description="Benchmark the parse, style, JS and render stages")
+    parser.add_argument("pages", nargs="*", help="pages in bench/corpus to run, all by default")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per page; the fastest is reported, being the least noisy")
+    parser.add_argument("--backend", choices=("headless", "tk"), default="headless",
+                        help="render into null widgets, or into Tk widgets (needs a display, e.g. xvfb-run)")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file to compare with or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="slowdown ratio counted as a regression, at least")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    pages = args.pages or sorted(name for name in os.listdir(CORPUS) if name.endswith(".html"))
+    main.Console.echo = False  # page console.log output would swamp the report
+    results, spread = RunCorpus(pages, max(1, args.repeat), args.backend)
+
+    baseline = {}
+    baseline_spread = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            stored = json.load(f)
+        if stored.get("machine", {}).get("backend") == args.backend:
+            baseline = stored["results"]
+            baseline_spread = stored.get("spread", {})
+        else:
+            sys.stderr.write("baseline is for another backend, not comparing\n")
+
+    lines, regressed = Compare(results, baseline, baseline_spread, args.threshold)
+    report = "\n".join(lines) + "\n"
+    sys.stdout.write(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"machine": Machine(args.backend), "repeat": args.repeat, "results": results, "spread": spread},
+                      f, indent=2)
+            f.write("\n")
+        return 0
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main(sys.argv[1:]))
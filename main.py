@@ -1,33 +1,340 @@
 import urllib.request
+import urllib.error
+import urllib.parse
+import http.client
+import zlib
 import tkinter as tk
 import tkinter.font
 import tkinter.messagebox
 from html.parser import HTMLParser
 import re
 import base64
+import codecs
+import io
+import os
+import json
+import hashlib
+import email.utils
 import sys
+import types
+import argparse
+import math
+import time
+import heapq
+import bisect
+import itertools
+import random
+import threading
+import queue
+import concurrent.futures
+from collections import OrderedDict, deque
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageTk
+except ImportError:
+    Image = ImageTk = None
 # Core modules
 
+# Shared by every element created without data or attributes; read-only
+# so nothing can write into it for all of them at once
+NO_DATA = types.MappingProxyType({})
+NO_ATTRS = types.MappingProxyType({})
+
+
 class HTMLElement():
-    def __init__(self, element_type, element_data={}, id=None, tags=None):
+    # A page has one of these per tag, end marker and text run, so they're
+    # slotted and the rarely used containers are only made when needed
+    __slots__ = ("type", "data", "id", "tags", "parent", "firstChild", "lastChild", "previousSibling", "nextSibling",
+                 "boundObject", "onclick", "_overrides")
+
+    def __init__(self, element_type, element_data=None, id=None, tags=(), parent=None):
         self.type = element_type
-        self.data = element_data
+        self.data = element_data if element_data is not None else NO_DATA
         self.id = id
-        self.tags = tags if tags is not None else []
+        self.tags = tags
+        # Tree links, set by the HTMLCollection the element goes into
+        self.parent = parent
+        self.firstChild = self.lastChild = None
+        self.previousSibling = self.nextSibling = None
         self.boundObject = None
         self.onclick = None
-        self.JSOveride = {}
+        self._overrides = None
+
+    @property
+    def JSOveride(self):
+        if self._overrides is None:
+            self._overrides = {}
+        return self._overrides
+
+    def text(self, default=None):
+        # The element's text: the last innerText/innerHTML a script set,
+        # else what was parsed
+        if self._overrides:
+            if "innerText" in self._overrides:
+                return self._overrides["innerText"]
+            if "innerHTML" in self._overrides:
+                return self._overrides["innerHTML"]
+        return self.data.get("content", default)
+
+    def children(self):
+        node = self.firstChild
+        while node is not None:
+            yield node
+            node = node.nextSibling
+
+    def subtree(self):
+        # The element and everything inside it, in document order
+        yield self
+        node = self.firstChild
+        while node is not None:
+            yield node
+            if node.firstChild is not None:
+                node = node.firstChild
+                continue
+            while node.nextSibling is None:
+                node = node.parent
+                if node is self:
+                    return
+            node = node.nextSibling
+
+    def lastDescendant(self):
+        # Where its subtree ends in the collection's elements
+        node = self
+        while node.lastChild is not None:
+            node = node.lastChild
+        return node
 
 
 class HTMLCollection():
+    # The document as a tree: elements with no parent are linked between
+    # the collection's own firstChild/lastChild. elements is the same tree
+    # flattened in document order, which is what gets painted; a subtree
+    # is always one run of it.
     def __init__(self):
         self.elements = []
-
-    def addObject(self, element_type, element_data={}, tags=None,element_id=None):
+        self.firstChild = self.lastChild = None
+        # id/tag/class -> elements (dicts used as ordered sets), kept in
+        # sync by addObject/insertObject/replaceObject
+        self.ids = {}
+        self.tag_index = {}
+        self.class_index = {}
+        # element -> position, only built when a splice left the indexes out of document order
+        self.positions = None
+        self.ordered = True
+        # Held by whoever changes or walks the collection while a page is
+        # still being parsed on a PageLoader thread
+        self.lock = threading.RLock()
+
+    def addObject(self, element_type, element_data=None, tags=(), element_id=None, parent=None):
         if element_id is None:
             element_id = len(self.elements) + 1
-        self.elements.append(HTMLElement(element_type, element_data, id=element_id, tags=tags))
-        return self.elements[-1]
+        element = HTMLElement(element_type, element_data, id=element_id, tags=tags, parent=parent)
+        # Anything added at the end is the last child of its (still open) parent
+        self.link(element, (parent if parent is not None else self).lastChild)
+        self.elements.append(element)
+        if self.positions is not None:
+            self.positions[element] = len(self.elements) - 1  # still right for everything before it
+        self.indexObject(element)
+        return element
+
+    def insertObject(self, index, element_type, element_data=None, tags=(), element_id=None, parent=None):
+        # addObject, but at index rather than at the end
+        if index >= len(self.elements):
+            return self.addObject(element_type, element_data, tags, element_id, parent)
+        if element_id is None:
+            element_id = len(self.elements) + 1
+        element = HTMLElement(element_type, element_data, id=element_id, tags=tags, parent=parent)
+        # It follows whichever child of parent the element before index is in
+        after = self.elements[index - 1] if index > 0 else None
+        while after is not None and after is not parent and after.parent is not parent:
+            after = after.parent
+        self.link(element, None if after is parent else after)
+        self.elements.insert(index, element)
+        self.indexObject(element)
+        self.ordered = False
+        self.positions = None
+        return element
+
+    def replaceObject(self, element, new_elements):
+        # Replaces element and its whole subtree (children and end marker)
+        # with new_elements, another collection's elements, returning the
+        # elements that were removed
+        removed = list(element.subtree())
+        idx = self.elements.index(element)
+        self.elements[idx:idx + len(removed)] = new_elements
+
+        after = element.previousSibling
+        self.unlink(element)
+        for new_element in new_elements:
+            if new_element.parent is None:
+                # A top-level element of the new content goes where element was
+                new_element.parent = element.parent
+                self.link(new_element, after)
+                after = new_element
+
+        for old_element in removed:
+            self.unindexObject(old_element)
+        for new_element in new_elements:
+            self.indexObject(new_element)
+        self.ordered = False
+        self.positions = None
+        return removed
+
+    def link(self, element, after):
+        # Puts element among its parent's children, right after sibling
+        # after, or first if that is None
+        container = element.parent if element.parent is not None else self
+        element.previousSibling = after
+        if after is None:
+            element.nextSibling = container.firstChild
+            container.firstChild = element
+        else:
+            element.nextSibling = after.nextSibling
+            after.nextSibling = element
+        if element.nextSibling is None:
+            container.lastChild = element
+        else:
+            element.nextSibling.previousSibling = element
+
+    def unlink(self, element):
+        container = element.parent if element.parent is not None else self
+        before, after = element.previousSibling, element.nextSibling
+        if before is None:
+            container.firstChild = after
+        else:
+            before.nextSibling = after
+        if after is None:
+            container.lastChild = before
+        else:
+            after.previousSibling = before
+        element.previousSibling = element.nextSibling = None
+
+    def contains(self, element):
+        # Whether element is still in the document, going up its ancestors
+        # rather than through every element
+        node = element
+        while node is not None:
+            container = node.parent if node.parent is not None else self
+            if container.firstChild is not node and node.previousSibling is None:
+                return False
+            node = node.parent
+        return True
+
+    def walk(self):
+        # Every element in document order, from the tree
+        node = self.firstChild
+        while node is not None:
+            yield from node.subtree()
+            node = node.nextSibling
+
+    def indexObject(self, element):
+        if isinstance(element.id, str):
+            self.ids.setdefault(element.id, {})[element] = None
+        if element.type.startswith("end_") or element.type == "text":
+            return
+        self.tag_index.setdefault(element.type, {})[element] = None
+        attrs = element.data.get("attrs")
+        if attrs and attrs.get("class"):
+            for class_name in attrs["class"].split():
+                self.class_index.setdefault(class_name, {})[element] = None
+
+    def unindexObject(self, element):
+        for index, key in [(self.ids, element.id), (self.tag_index, element.type)]:
+            bucket = index.get(key)
+            if bucket and element in bucket:
+                del bucket[element]
+                if not bucket:
+                    del index[key]
+        attrs = element.data.get("attrs")
+        if attrs and attrs.get("class"):
+            for class_name in attrs["class"].split():
+                bucket = self.class_index.get(class_name)
+                if bucket and element in bucket:
+                    del bucket[element]
+                    if not bucket:
+                        del self.class_index[class_name]
+
+    def inDocumentOrder(self, bucket):
+        if self.ordered or len(bucket) < 2:
+            return list(bucket)
+        if self.positions is None:
+            self.positions = {element: i for i, element in enumerate(self.elements)}
+        return sorted(bucket, key=self.positions.__getitem__)
+
+    def getElementById(self, element_id):
+        bucket = self.ids.get(element_id)
+        if not bucket:
+            return None
+        if len(bucket) == 1:
+            return next(iter(bucket))
+        return self.inDocumentOrder(bucket)[0]
+
+    def getElementsByTagName(self, tag):
+        return self.inDocumentOrder(self.tag_index.get(tag.lower(), ()))
+
+    def getElementsByClassName(self, class_name):
+        return self.inDocumentOrder(self.class_index.get(class_name, ()))
+
+
+# ================== FONTS ==================
+
+class CachedFont(tkinter.font.Font):
+    # A font that remembers its measurements; shared fonts never change
+    # their attributes, so the memo stays valid.
+    max_measures = 4096
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.widths = {}
+        self._linespace = None
+
+    def measure(self, text, displayof=None):
+        width = self.widths.get(text)
+        if width is None:
+            if len(self.widths) >= self.max_measures:
+                self.widths.clear()
+            width = self.widths[text] = super().measure(text)
+        return width
+
+    def linespace(self):
+        if self._linespace is None:
+            self._linespace = self.metrics("linespace")
+        return self._linespace
+
+
+class _FontRegistry:
+    # One Tk font per (family, size, weight, underline), least recently used
+    # ones dropped past max_fonts. Tk keeps a dropped font alive for as long
+    # as a widget still uses it.
+    def __init__(self, max_fonts=64):
+        self.fonts = OrderedDict()
+        self.max_fonts = max_fonts
+
+    def get(self, family, size, weight="normal", underline=False):
+        key = (family, size, weight, bool(underline))
+        font = self.fonts.get(key)
+        if font is not None:
+            self.fonts.move_to_end(key)
+            return font
+        font = self.fonts[key] = CachedFont(family=family, size=size, weight=weight, underline=underline)
+        if len(self.fonts) > self.max_fonts:
+            self.fonts.popitem(last=False)
+        return font
+
+    def fromTuple(self, font_tuple, underline=False):
+        weight = font_tuple[2] if len(font_tuple) > 2 else "normal"
+        return self.get(font_tuple[0], font_tuple[1], weight, underline)
+
+    def clear(self):
+        self.fonts.clear()
+
+
+Fonts = _FontRegistry()
 
 
 # ================== CUSTOM WIDGETS ==================
@@ -43,16 +350,14 @@ class TransparentLabel(tk.Canvas):
             if master:
                 kwargs["bg"] = master.cget("bg")
 
-        family = font_tuple[0]
-        size = font_tuple[1]
-        weight = "normal"
-        if len(font_tuple) > 2:
-            weight = font_tuple[2]
-
-        self.font = tkinter.font.Font(family=family, size=size, weight=weight, underline=underline)
+        # Fonts are shared through Fonts, so changing them means picking
+        # another shared font rather than reconfiguring this one
+        self.font_tuple = font_tuple
+        self.underline = underline
+        self.font = Fonts.fromTuple(font_tuple, underline)
 
         width = self.font.measure(text)
-        height = self.font.metrics("linespace")
+        height = self.font.linespace()
 
         super().__init__(master, width=width, height=height, **kwargs)
 
@@ -66,42 +371,31 @@ class TransparentLabel(tk.Canvas):
 
         font_updated = False
         if 'underline' in kwargs:
-            self.font.config(underline=kwargs.pop('underline'))
+            self.underline = kwargs.pop('underline')
             font_updated = True
 
         if 'font' in kwargs:
-            font_tuple = kwargs.pop('font')
-            family = font_tuple[0]
-            size = font_tuple[1]
-            weight = "normal"
-            if len(font_tuple) > 2:
-                weight = font_tuple[2]
-            self.font.config(family=family, size=size, weight=weight)
-
-            width = self.font.measure(self.text_content)
-            height = self.font.metrics("linespace")
-            super().config(width=width, height=height)
+            self.font_tuple = kwargs.pop('font')
             font_updated = True
 
         if font_updated:
+            self.font = Fonts.fromTuple(self.font_tuple, self.underline)
             self.itemconfig(self.text_id, font=self.font)
-        if "text" in kwargs:
-            self.text_content = kwargs.pop('text')
-            self.itemconfig(self.text_id, text=self.text_content)
-            width = self.font.measure(self.text_content)
-            height = self.font.metrics("linespace")
-            super().config(width=width, height=height)
-        if "text_content" in kwargs:
-            self.text_content =kwargs.pop('text_content')
+            if 'text' not in kwargs and 'text_content' not in kwargs:
+                kwargs['text_content'] = self.text_content
+
+        text = kwargs.pop('text', None)
+        if 'text_content' in kwargs:
+            text = kwargs.pop('text_content')
+        if text is not None:
+            self.text_content = text
             self.itemconfig(self.text_id, text=self.text_content)
             width = self.font.measure(self.text_content)
-            height = self.font.metrics("linespace")
+            height = self.font.linespace()
             super().config(width=width, height=height)
 
-
-
-
-        super().config(**kwargs)
+        if kwargs:
+            super().config(**kwargs)
 
     def configure(self, **kwargs):
         self.config(**kwargs)
@@ -122,6 +416,7 @@ class ConsoleObject:
 class _Console:
     def __init__(self):
         self.log = []
+        self.echo = True  # off when the log is collected instead, e.g. headless
     def print(self, *args, sep=' ', end='\n', file=None,type = "info",flush = True):
 
         text = sep.join([str(arg) for arg in args])
@@ -133,6 +428,8 @@ class _Console:
 
         #print(text, end=end, file=file)
     def render(self):
+        if not self.echo:
+            return
         #Use sys.stdout
         output,_ = [(obj.text + obj.end,obj.type) if not obj.logged else ("",None) for obj in self.log], [obj.setLogged() for obj in self.log]
         [sys.stdout.write(obj[0]) if obj[1] == "info" else sys.stderr.write(obj[0]) for obj in output]
@@ -148,27 +445,1017 @@ print = Console.print
 
 
 
+# ================== JS EXPRESSIONS ==================
+
+class JSSyntaxError(Exception):
+    pass
+
+
+JS_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<number>\d+\.\d*|\.\d+|\d+)
+   |(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+   |(?P<name>[A-Za-z_$][\w$]*)
+   |(?P<op>===|!==|==|!=|<=|>=|&&|\|\||[-+*/%<>!?:.,()\[\]{}])
+)""", re.VERBOSE)
+
+JS_STRING_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0"}
+
+# Binary operator precedences, higher binds tighter
+JS_PRECEDENCE = {
+    "||": 1, "&&": 2,
+    "==": 3, "!=": 3, "===": 3, "!==": 3,
+    "<": 4, ">": 4, "<=": 4, ">=": 4,
+    "+": 5, "-": 5,
+    "*": 6, "/": 6, "%": 6,
+}
+
+JS_LITERALS = {"true": True, "false": False, "null": None, "undefined": None}
+
+
+def tokenize_js(text):
+    tokens = []
+    pos = 0
+    end = len(text.rstrip())
+    while pos < end:
+        m = JS_TOKEN_RE.match(text, pos)
+        if not m:
+            raise JSSyntaxError(f"Unexpected character {text[pos:].strip()[:1]!r} in {text!r}")
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "string":
+            value = re.sub(r"\\(.)", lambda e: JS_STRING_ESCAPES.get(e.group(1), e.group(1)), value[1:-1])
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+class JSExpressionParser:
+    # Precedence-climbing parser producing a tuple tree:
+    # ("literal", v) ("name", n) ("array", items) ("object", pairs)
+    # ("member", obj, name) ("index", obj, key) ("call", callee, args)
+    # ("new", name, args) ("unary", op, operand) ("binary", op, left, right)
+    # ("ternary", cond, then, otherwise)
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize_js(text)
+        self.pos = 0
+
+    def parse(self):
+        node = self.parse_ternary()
+        if self.pos < len(self.tokens):
+            raise JSSyntaxError(f"Unexpected {self.tokens[self.pos][1]!r} in {self.text!r}")
+        return node
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise JSSyntaxError(f"Unexpected end of expression {self.text!r}")
+        self.pos += 1
+        return token
+
+    def accept(self, op):
+        if self.peek() == ("op", op):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, op):
+        if not self.accept(op):
+            raise JSSyntaxError(f"Expected {op!r} in {self.text!r}")
+
+    def parse_ternary(self):
+        node = self.parse_binary(1)
+        if self.accept("?"):
+            then = self.parse_ternary()
+            self.expect(":")
+            node = ("ternary", node, then, self.parse_ternary())
+        return node
+
+    def parse_binary(self, min_prec):
+        left = self.parse_unary()
+        while True:
+            kind, op = self.peek()
+            prec = JS_PRECEDENCE.get(op) if kind == "op" else None
+            if prec is None or prec < min_prec:
+                return left
+            self.pos += 1
+            left = ("binary", op, left, self.parse_binary(prec + 1))
+
+    def parse_unary(self):
+        kind, value = self.peek()
+        if (kind == "op" and value in ("-", "+", "!")) or (kind == "name" and value == "typeof"):
+            self.pos += 1
+            return ("unary", value, self.parse_unary())
+        if kind == "name" and value == "new":
+            self.pos += 1
+            kind, name = self.next()
+            args = self.parse_arguments() if self.accept("(") else ()
+            return self.parse_postfix(("new", name, args))
+        return self.parse_postfix(self.parse_primary())
+
+    def parse_arguments(self):
+        args = []
+        if not self.accept(")"):
+            args.append(self.parse_ternary())
+            while self.accept(","):
+                args.append(self.parse_ternary())
+            self.expect(")")
+        return tuple(args)
+
+    def parse_postfix(self, node):
+        while True:
+            if self.accept("."):
+                kind, name = self.next()
+                if kind != "name":
+                    raise JSSyntaxError(f"Expected property name in {self.text!r}")
+                node = ("member", node, name)
+            elif self.accept("["):
+                node = ("index", node, self.parse_ternary())
+                self.expect("]")
+            elif self.accept("("):
+                node = ("call", node, self.parse_arguments())
+            else:
+                return node
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind in ("number", "string"):
+            return ("literal", value)
+        if kind == "name":
+            if value in JS_LITERALS:
+                return ("literal", JS_LITERALS[value])
+            return ("name", value)
+        if value == "(":
+            node = self.parse_ternary()
+            self.expect(")")
+            return node
+        if value == "[":
+            items = []
+            if not self.accept("]"):
+                items.append(self.parse_ternary())
+                while self.accept(","):
+                    items.append(self.parse_ternary())
+                self.expect("]")
+            return ("array", tuple(items))
+        if value == "{":
+            pairs = []
+            while not self.accept("}"):
+                kind, key = self.next()
+                if kind not in ("name", "string", "number"):
+                    raise JSSyntaxError(f"Bad object key in {self.text!r}")
+                self.expect(":")
+                pairs.append((str(key), self.parse_ternary()))
+                if not self.accept(","):
+                    self.expect("}")
+                    break
+            return ("object", tuple(pairs))
+        raise JSSyntaxError(f"Unexpected {value!r} in {self.text!r}")
+
+
+# ---------- JS value semantics ----------
+
+def js_to_string(value):
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value is None:
+        return "null"
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    if isinstance(value, list):
+        return ",".join("" if v is None else js_to_string(v) for v in value)
+    if isinstance(value, dict):
+        return "[object Object]"
+    return str(value)
+
+
+def js_to_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    if value is None or value == "":
+        return 0
+    try:
+        text = str(value).strip()
+        return float(text) if "." in text or "e" in text.lower() else int(text)
+    except ValueError:
+        return math.nan
+
+
+def js_truthy(value):
+    if isinstance(value, (list, dict)):
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return False
+    return bool(value)
+
+
+def js_add(a, b):
+    if isinstance(a, str) or isinstance(b, str) or isinstance(a, (list, dict)) or isinstance(b, (list, dict)):
+        return js_to_string(a) + js_to_string(b)
+    return js_to_number(a) + js_to_number(b)
+
+
+def js_divide(a, b):
+    a, b = js_to_number(a), js_to_number(b)
+    if b == 0:
+        return math.nan if a == 0 else math.copysign(math.inf, a)
+    return a / b
+
+
+def js_modulo(a, b):
+    a, b = js_to_number(a), js_to_number(b)
+    if b == 0:
+        return math.nan
+    result = math.fmod(a, b)
+    if isinstance(a, int) and isinstance(b, int):
+        return int(result)
+    return result
+
+
+def js_loose_equals(a, b):
+    if type(a) is type(b) or a is None or b is None:
+        return js_strict_equals(a, b)
+    if isinstance(a, (list, dict)) or isinstance(b, (list, dict)):
+        return js_to_string(a) == js_to_string(b)
+    return js_to_number(a) == js_to_number(b)
+
+
+def js_strict_equals(a, b):
+    if isinstance(a, (list, dict)) or isinstance(b, (list, dict)):
+        return a is b
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+    if isinstance(a, str) != isinstance(b, str):
+        return False
+    return a == b
+
+
+def js_compare(op, a, b):
+    if not (isinstance(a, str) and isinstance(b, str)):
+        a, b = js_to_number(a), js_to_number(b)
+    if op == "<":
+        return a < b
+    if op == ">":
+        return a > b
+    if op == "<=":
+        return a <= b
+    return a >= b
+
+
+def js_index(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def js_get_member(obj, name):
+    if isinstance(obj, dict):
+        return obj.get(name)
+    if name == "length" and isinstance(obj, (list, str)):
+        return len(obj)
+    # Host objects show scripts only the members their class lists in
+    # js_members, so nothing else of Python is reachable from a page
+    if not name.startswith("_") and name in getattr(type(obj), "js_members", ()):
+        return getattr(obj, name)
+    return None
+
+
+def js_get_index(obj, key):
+    key = js_index(key)
+    if isinstance(obj, (list, str)):
+        if isinstance(key, int) and 0 <= key < len(obj):
+            return obj[key]
+        if isinstance(key, str):
+            return js_get_member(obj, key)
+        return None
+    if isinstance(obj, dict):
+        return obj.get(js_to_string(key) if not isinstance(key, str) else key)
+    return None
+
+
+def js_set_index(obj, key, value):
+    key = js_index(key)
+    if isinstance(obj, list):
+        key = int(key)
+        if key >= len(obj):
+            obj.extend([None] * (key + 1 - len(obj)))
+        obj[key] = value
+    elif isinstance(obj, dict):
+        obj[js_to_string(key)] = value
+
+
+def js_array_method(arr, name, args):
+    if name == "push":
+        arr.extend(args)
+        return len(arr)
+    if name == "pop":
+        return arr.pop() if arr else None
+    if name == "shift":
+        return arr.pop(0) if arr else None
+    if name == "unshift":
+        arr[0:0] = args
+        return len(arr)
+    if name == "fill":
+        arr[:] = [args[0] if args else None] * len(arr)
+        return arr
+    if name == "indexOf":
+        for i, item in enumerate(arr):
+            if js_strict_equals(item, args[0]):
+                return i
+        return -1
+    if name == "includes":
+        return any(js_strict_equals(item, args[0]) for item in arr)
+    if name == "join":
+        sep = js_to_string(args[0]) if args else ","
+        return sep.join("" if v is None else js_to_string(v) for v in arr)
+    if name == "slice":
+        return arr[slice(*[int(js_to_number(a)) for a in args])]
+    if name == "concat":
+        result = list(arr)
+        for a in args:
+            result.extend(a if isinstance(a, list) else [a])
+        return result
+    if name == "reverse":
+        arr.reverse()
+        return arr
+    raise TypeError(f"Array has no method {name}")
+
+
+def js_string_method(text, name, args):
+    if name == "toUpperCase":
+        return text.upper()
+    if name == "toLowerCase":
+        return text.lower()
+    if name == "trim":
+        return text.strip()
+    if name == "charAt":
+        i = int(js_to_number(args[0])) if args else 0
+        return text[i] if 0 <= i < len(text) else ""
+    if name == "indexOf":
+        return text.find(js_to_string(args[0]))
+    if name == "includes":
+        return js_to_string(args[0]) in text
+    if name in ("slice", "substring"):
+        return text[slice(*[int(js_to_number(a)) for a in args])]
+    if name == "split":
+        if not args:
+            return [text]
+        sep = js_to_string(args[0])
+        return list(text) if sep == "" else text.split(sep)
+    if name == "repeat":
+        return text * int(js_to_number(args[0]))
+    raise TypeError(f"String has no method {name}")
+
+
+def js_call_method(obj, name, args):
+    if isinstance(obj, list):
+        return js_array_method(obj, name, args)
+    if isinstance(obj, str):
+        return js_string_method(obj, name, args)
+    if isinstance(obj, (int, float)) and name == "toFixed":
+        return f"{obj:.{int(js_to_number(args[0])) if args else 0}f}"
+    func = js_get_member(obj, name)
+    if not callable(func):
+        raise TypeError(f"{name} is not a function")
+    return func(*args)
+
+
+def js_new(name, args):
+    if name == "Array":
+        if len(args) == 1 and isinstance(args[0], (int, float)):
+            return [None] * int(args[0])
+        return list(args)
+    if name == "Object":
+        return {}
+    raise TypeError(f"{name} is not a constructor")
+
+
+JS_GLOBALS = {
+    "Math": {
+        "floor": math.floor, "ceil": math.ceil, "round": lambda x: math.floor(x + 0.5),
+        "abs": abs, "max": max, "min": min, "sqrt": math.sqrt, "pow": pow,
+        "random": random.random, "PI": math.pi,
+    },
+    "parseInt": lambda x, base=10: int(str(x).strip().split(".")[0], int(base)),
+    "parseFloat": lambda x: float(x),
+    "String": js_to_string,
+    "Number": js_to_number,
+    "isNaN": lambda x: math.isnan(js_to_number(x)),
+}
+
+
+# ---------- scopes ----------
+
+class JSScope:
+    # Compile-time scope. Function scopes own a frame of slots; block scopes
+    # only map their let/const names onto slots of the enclosing function's
+    # frame, so running a block never allocates. Names declared directly in
+    # the script scope are globals and live in SimpleJSInterpreter.vars.
+    def __init__(self, parent=None, function=False, script=False):
+        self.parent = parent
+        self.names = {}
+        self.script = script
+        self.function = self if (function or script) else parent.function
+        self.size = 0
+
+    def declare(self, name, kind="let"):
+        scope = self.function if kind == "var" else self
+        if scope.script:
+            return None
+        if name not in scope.names:
+            scope.function.size += 1
+            scope.names[name] = scope.function.size
+        return scope.names[name]
+
+    def resolve(self, name):
+        # Returns (depth, slot) where depth counts the frames to walk up,
+        # or None when the name is a global.
+        scope = self
+        depth = 0
+        while scope is not None:
+            if name in scope.names:
+                return depth, scope.names[name]
+            if scope.function is scope:
+                depth += 1
+            scope = scope.parent
+        return None
+
+
+class JSFunction:
+    # A compiled function body plus the frame it closes over. Frames are
+    # lists: frame[0] is the parent frame and frame[1:] the slots.
+    __slots__ = ("block", "size", "params", "env")
+
+    def __init__(self, block, size, params=(), env=None):
+        self.block = block
+        self.size = size
+        self.params = params
+        self.env = env
+
+    def bind(self, env):
+        return JSFunction(self.block, self.size, self.params, env)
+
+    def new_frame(self, args=()):
+        frame = [self.env] + [None] * self.size
+        for slot, value in zip(self.params, args):
+            frame[slot] = value
+        return frame
+
+
+def js_frame_at(env, depth):
+    for _ in range(depth):
+        env = env[0]
+    return env
+
+
+def build_js_load(name, scope):
+    location = scope.resolve(name)
+    if location is None:
+        default = JS_GLOBALS.get(name, "")
+
+        def load_global(js, env):
+            try:
+                return js.vars[name]
+            except KeyError:
+                if name in js.functions:
+                    return js.functions[name]
+                return js.builtins.get(name, default)
+        return load_global
+    depth, slot = location
+    if depth == 0:
+        return lambda js, env: env[slot]
+    if depth == 1:
+        return lambda js, env: env[0][slot]
+    return lambda js, env: js_frame_at(env, depth)[slot]
+
+
+def build_js_store(name, scope):
+    location = scope.resolve(name)
+    if location is None:
+        def store_global(js, env, value):
+            js.vars[name] = value
+        return store_global
+    depth, slot = location
+
+    def store(js, env, value):
+        js_frame_at(env, depth)[slot] = value
+    return store
+
+
+# ---------- closure compiler ----------
+
+JS_BINARY_OPS = {
+    "+": js_add,
+    "-": lambda a, b: js_to_number(a) - js_to_number(b),
+    "*": lambda a, b: js_to_number(a) * js_to_number(b),
+    "/": js_divide,
+    "%": js_modulo,
+    "==": js_loose_equals,
+    "!=": lambda a, b: not js_loose_equals(a, b),
+    "===": js_strict_equals,
+    "!==": lambda a, b: not js_strict_equals(a, b),
+    "<": lambda a, b: js_compare("<", a, b),
+    ">": lambda a, b: js_compare(">", a, b),
+    "<=": lambda a, b: js_compare("<=", a, b),
+    ">=": lambda a, b: js_compare(">=", a, b),
+}
+
+
+def js_typeof(value):
+    if value is None:
+        return "undefined"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if callable(value) or isinstance(value, JSFunction):
+        return "function"
+    return "object"
+
+
+def build_js_expression(node, scope):
+    # Turns a parsed expression tree into nested closures taking the
+    # interpreter and the current frame. Names are resolved against scope
+    # here, once, so evaluation is a chain of direct calls and slot reads.
+    kind = node[0]
+
+    if kind == "literal":
+        value = node[1]
+        return lambda js, env: value
+
+    if kind == "name":
+        return build_js_load(node[1], scope)
+
+    if kind == "array":
+        items = [build_js_expression(item, scope) for item in node[1]]
+        return lambda js, env: [item(js, env) for item in items]
+
+    if kind == "object":
+        pairs = [(key, build_js_expression(value, scope)) for key, value in node[1]]
+        return lambda js, env: {key: value(js, env) for key, value in pairs}
+
+    if kind == "member":
+        obj = build_js_expression(node[1], scope)
+        name = node[2]
+        return lambda js, env: js_get_member(obj(js, env), name)
+
+    if kind == "index":
+        obj = build_js_expression(node[1], scope)
+        key = build_js_expression(node[2], scope)
+        return lambda js, env: js_get_index(obj(js, env), key(js, env))
+
+    if kind == "call":
+        callee = node[1]
+        args = [build_js_expression(arg, scope) for arg in node[2]]
+        if callee[0] == "member":
+            obj = build_js_expression(callee[1], scope)
+            name = callee[2]
+            return lambda js, env: js_call_method(obj(js, env), name, [arg(js, env) for arg in args])
+        if callee[0] == "name" and scope.resolve(callee[1]) is None:
+            name = callee[1]
+            return lambda js, env: js.call_function(name, [arg(js, env) for arg in args])
+        func = build_js_expression(callee, scope)
+        return lambda js, env: js.call_value(func(js, env), [arg(js, env) for arg in args])
+
+    if kind == "new":
+        name = node[1]
+        args = [build_js_expression(arg, scope) for arg in node[2]]
+        return lambda js, env: js_new(name, [arg(js, env) for arg in args])
+
+    if kind == "unary":
+        op = node[1]
+        operand = build_js_expression(node[2], scope)
+        if op == "-":
+            return lambda js, env: -js_to_number(operand(js, env))
+        if op == "+":
+            return lambda js, env: js_to_number(operand(js, env))
+        if op == "!":
+            return lambda js, env: not js_truthy(operand(js, env))
+        return lambda js, env: js_typeof(operand(js, env))
+
+    if kind == "binary":
+        op = node[1]
+        left = build_js_expression(node[2], scope)
+        right = build_js_expression(node[3], scope)
+        if op == "&&":
+            def logical_and(js, env):
+                value = left(js, env)
+                return right(js, env) if js_truthy(value) else value
+            return logical_and
+        if op == "||":
+            def logical_or(js, env):
+                value = left(js, env)
+                return value if js_truthy(value) else right(js, env)
+            return logical_or
+        func = JS_BINARY_OPS[op]
+        return lambda js, env: func(left(js, env), right(js, env))
+
+    if kind == "ternary":
+        cond = build_js_expression(node[1], scope)
+        then = build_js_expression(node[2], scope)
+        otherwise = build_js_expression(node[3], scope)
+        return lambda js, env: then(js, env) if js_truthy(cond(js, env)) else otherwise(js, env)
+
+    raise JSSyntaxError(f"Unknown expression node {kind}")
+
+
+def compile_js_expression(tree, scope):
+    # Returns a callable evaluating a parsed expression in scope; errors are
+    # reported on the console and evaluate to "" like undefined variables.
+    if isinstance(tree, JSSyntaxError):
+        message = str(tree)
+
+        def syntax_error(js, env):
+            print("Evaluation Error:", message, type="error")
+            return ""
+        return syntax_error
+
+    func = build_js_expression(tree, scope)
+
+    def evaluate(js, env):
+        try:
+            return func(js, env)
+        except Exception as e:
+            print("Evaluation Error:", e, type="error")
+            return ""
+    return evaluate
+
+
+# ================== JS EVENT LOOP ==================
+
+class JSEventLoop:
+    # One task queue per page for setTimeout/setInterval/requestAnimationFrame.
+    # Everything is driven by a single root.after chain: each tick runs the
+    # due timers and animation frames, then flushes the DOM writes they made
+    # in one batch. Ticks are at least frame_ms apart so timers that fall due
+    # close together share a frame, and nothing is scheduled while idle.
+    min_interval_ms = 4  # shortest setInterval period, as in browsers
+
+    def __init__(self, js, root=None, frame_ms=16):
+        self.js = js
+        self.root = root
+        self.frame_ms = frame_ms
+        self.timers = {}  # id -> [func, args, interval_ms or None, due]
+        self.queue = []  # heap of (due, id)
+        self.animation_frames = {}
+        self.dom_writes = {}
+        self.next_id = 1
+        self.after_id = None
+        self.next_tick = None
+        self.last_tick = 0
+        self.in_tick = False
+        self.stopped = False
+        self.paused_at = None
+
+    def setTimeout(self, func, delay=0, *args):
+        return self.add_timer(func, args, js_to_number(delay), None)
+
+    def setInterval(self, func, delay=0, *args):
+        delay = js_to_number(delay)
+        if not delay >= self.min_interval_ms:  # also NaN
+            delay = self.min_interval_ms
+        return self.add_timer(func, args, delay, delay)
+
+    def clearTimeout(self, timer_id=None):
+        self.timers.pop(timer_id, None)
+
+    clearInterval = clearTimeout
+
+    def requestAnimationFrame(self, func):
+        timer_id = self.new_id()
+        self.animation_frames[timer_id] = func
+        self.schedule(time.monotonic())
+        return timer_id
+
+    def cancelAnimationFrame(self, timer_id=None):
+        self.animation_frames.pop(timer_id, None)
+
+    def queue_dom_write(self, key, apply):
+        # Later writes to the same key replace earlier ones within a frame
+        self.dom_writes[key] = apply
+        if not self.in_tick:
+            self.schedule(time.monotonic())
+
+    def new_id(self):
+        timer_id = self.next_id
+        self.next_id += 1
+        return timer_id
+
+    def add_timer(self, func, args, delay, interval):
+        if self.stopped:
+            return 0
+        timer_id = self.new_id()
+        due = time.monotonic() + max(delay, 0) / 1000
+        self.timers[timer_id] = [func, args, interval, due]
+        heapq.heappush(self.queue, (due, timer_id))
+        self.schedule(due)
+        return timer_id
+
+    def schedule(self, due):
+        if self.stopped or self.in_tick or self.root is None or self.paused_at is not None:
+            return
+        due = max(due, self.last_tick + self.frame_ms / 1000)
+        if self.after_id is not None:
+            if self.next_tick <= due:
+                return
+            self.root.after_cancel(self.after_id)
+        self.next_tick = due
+        self.after_id = self.root.after(max(int((due - time.monotonic()) * 1000), 0), self.tick)
+
+    def run_callback(self, func, args):
+        try:
+            self.js.run(func, args=args)
+        except Exception as e:
+            print("JS error:", e, type="error")
+
+    def tick(self):
+        self.after_id = None
+        if self.stopped or self.paused_at is not None:
+            return
+        now = self.last_tick = time.monotonic()
+        self.in_tick = True
+        lock = self.js.html_collection.lock
+        lock.acquire()
+        try:
+            while self.queue and self.queue[0][0] <= now:
+                due, timer_id = heapq.heappop(self.queue)
+                timer = self.timers.get(timer_id)
+                if timer is None or timer[3] != due:
+                    continue  # cleared, or a stale entry of a rescheduled interval
+                func, args, interval, _ = timer
+                if interval is None:
+                    del self.timers[timer_id]
+                else:
+                    # Never due again within this tick, however far behind
+                    timer[3] = max(due + interval / 1000, now + self.min_interval_ms / 1000)
+                    heapq.heappush(self.queue, (timer[3], timer_id))
+                self.run_callback(func, args)
+
+            frames, self.animation_frames = self.animation_frames, {}
+            for func in frames.values():
+                self.run_callback(func, (now * 1000,))
+
+            self.flush()
+        finally:
+            self.in_tick = False
+            lock.release()
+
+        if self.animation_frames or self.dom_writes:
+            self.schedule(now)
+        elif self.queue:
+            self.schedule(self.queue[0][0])
+
+    def flush(self):
+        writes, self.dom_writes = self.dom_writes, {}
+        for apply in writes.values():
+            try:
+                apply()
+            except tk.TclError:
+                pass  # the widget went away with a re-render
+            except Exception as e:
+                # One bad write mustn't stop the rest, or the tick rescheduling
+                print("JS error:", e, type="error")
+
+    def pause(self):
+        # Holds every timer where it is, e.g. while the page is in the
+        # back/forward cache
+        if self.paused_at is not None or self.stopped:
+            return
+        self.paused_at = time.monotonic()
+        if self.after_id is not None and self.root is not None:
+            self.root.after_cancel(self.after_id)
+        self.after_id = None
+
+    def resume(self):
+        # Timers pick up with the time they had left when paused
+        if self.paused_at is None:
+            return
+        shift = time.monotonic() - self.paused_at
+        self.paused_at = None
+        for timer in self.timers.values():
+            timer[3] += shift
+        self.queue = [(timer[3], timer_id) for timer_id, timer in self.timers.items()]
+        heapq.heapify(self.queue)
+        if self.animation_frames or self.dom_writes:
+            self.schedule(time.monotonic())
+        elif self.queue:
+            self.schedule(self.queue[0][0])
+
+    def stop(self):
+        self.stopped = True
+        if self.after_id is not None and self.root is not None:
+            self.root.after_cancel(self.after_id)
+        self.after_id = None
+        self.timers.clear()
+        self.queue.clear()
+        self.animation_frames.clear()
+        self.dom_writes.clear()
+
+
 # ================== SIMPLE JAVASCRIPT INTERPRETER ==================
 
+class JSDocument:
+    # What scripts get as document: element lookups and write, without the
+    # collection's lock, lists and indexes or a way back to the renderer
+    __slots__ = ("_collection", "_write")
+    js_members = frozenset({"getElementById", "getElementsByTagName", "getElementsByClassName", "write"})
+
+    def __init__(self, collection, write):
+        self._collection = collection
+        self._write = write
+
+    def getElementById(self, element_id):
+        return self._collection.getElementById(element_id)
+
+    def getElementsByTagName(self, tag):
+        return self._collection.getElementsByTagName(tag)
+
+    def getElementsByClassName(self, class_name):
+        return self._collection.getElementsByClassName(class_name)
+
+    def write(self, text=""):
+        self._write(text)
+
+
 class SimpleJSInterpreter:
+    # Compiled scripts are JSFunction templates of plain tuples with no
+    # interpreter state, so the cache is shared by every page/interpreter
+    # and keyed by source text. Parsed expressions are cached by text too and
+    # bound to a scope when a script is compiled.
+    compiled_cache = OrderedDict()
+    compiled_cache_size = 512
+    expression_cache = OrderedDict()
+    expression_cache_size = 2048
+
     def __init__(self, html_collection, renderer=None):
         self.html_collection = html_collection
         self.renderer = renderer
         self.vars = {}
         self.functions = {}
-
-    def run(self, code, tag_stack=None):
-        #print(code)
+        root = None
+        if renderer is not None and renderer.visualSystem is not None:
+            root = renderer.visualSystem.root
+        self.loop = JSEventLoop(self, root)
+        self.key_binding = None
+        self.key_handler = None
+        # element -> [removed, new_elements] for outerHTML patches not yet on screen
+        self.pending_patches = {}
+        # (index, parent) document.write inserts at while a deferred script runs
+        self.write_at = None
+        # Plain functions and a facade rather than bound methods and the
+        # collection itself, so no member leads a script back to Python
+        self.builtins = {
+            "setTimeout": lambda func, delay=0, *args: self.loop.setTimeout(func, delay, *args),
+            "setInterval": lambda func, delay=0, *args: self.loop.setInterval(func, delay, *args),
+            "clearTimeout": lambda timer_id=None: self.loop.clearTimeout(timer_id),
+            "clearInterval": lambda timer_id=None: self.loop.clearInterval(timer_id),
+            "requestAnimationFrame": lambda func: self.loop.requestAnimationFrame(func),
+            "cancelAnimationFrame": lambda timer_id=None: self.loop.cancelAnimationFrame(timer_id),
+            "document": JSDocument(html_collection, lambda text: self.document_write(text, [])),
+        }
+        self.ops = {
+            "alert": self.op_alert,
+            "function": self.op_function,
+            "call": self.op_call,
+            "if": self.op_if,
+            "for": self.op_for,
+            "timer": self.op_timer,
+            "keydown": self.op_keydown,
+            "write": self.op_write,
+            "log": self.op_log,
+            "declare": self.op_declare,
+            "pop": self.op_pop,
+            "unshift": self.op_unshift,
+            "setindex": self.op_setindex,
+            "assign": self.op_assign,
+            "incr": self.op_incr,
+            "expr": self.op_expr,
+            "onclick": self.op_onclick,
+            "innerText": self.op_inner_text,
+            "innerHTML": self.op_inner_html,
+            "outerHTML": self.op_outer_html,
+            "error": self.op_error,
+        }
+
+    def run(self, code, tag_stack=None, args=()):
+        # code is script text or a compiled JSFunction (a handler closure)
         if tag_stack is None:
             tag_stack = []
-        lines = self.split_statements(code)
-        print(lines)
+        if isinstance(code, str):
+            code = self.compile(code)
+        with self.html_collection.lock:
+            self.execute(code.block, code.new_frame(args), tag_stack)
+
+    def execute(self, block, env, tag_stack):
+        ops = self.ops
+        for node in block:
+            ops[node[0]](node, env, tag_stack)
+
+    # ---------- compiler ----------
+    def compile(self, code):
+        cache = SimpleJSInterpreter.compiled_cache
+        program = cache.get(code)
+        if program is not None:
+            cache.move_to_end(code)
+            return program
+        scope = JSScope(script=True)
+        block = self.compile_lines(self.split_statements(code), scope)
+        program = JSFunction(block, scope.size)
+        cache[code] = program
+        if len(cache) > SimpleJSInterpreter.compiled_cache_size:
+            cache.popitem(last=False)
+        return program
+
+    def expression(self, text, scope):
+        cache = SimpleJSInterpreter.expression_cache
+        text = text.strip()
+        tree = cache.get(text)
+        if tree is not None:
+            cache.move_to_end(text)
+        else:
+            try:
+                tree = JSExpressionParser(text).parse()
+            except JSSyntaxError as e:
+                tree = e
+            cache[text] = tree
+            if len(cache) > SimpleJSInterpreter.expression_cache_size:
+                cache.popitem(last=False)
+        return compile_js_expression(tree, scope)
+
+    def compile_function(self, lines, i, scope, params=()):
+        # Compiles a function body in its own frame; params take the first slots
+        function_scope = JSScope(scope, function=True)
+        for param in params:
+            function_scope.declare(param)
+        body, i, rest = self.collect_block(lines, i, function_scope)
+        template = JSFunction(body, function_scope.size, tuple(range(1, len(params) + 1)))
+        return template, i, rest
+
+    def collect_block(self, lines, i, scope):
+        # Compiles the brace-delimited body opened on lines[i] in scope. Whatever
+        # follows the closing brace on its line (an "else", the ", 100)" of a
+        # setInterval...) is left in lines[i] for the caller to parse next;
+        # returns the compiled body, the new index and that remainder.
+        body = []
+        depth = 0
+        quote = None
+        text = lines[i]
+        start = text.index("{")
+        p = start
+        while True:
+            while p < len(text):
+                c = text[p]
+                if quote:
+                    if c == "\\":
+                        p += 1
+                    elif c == quote:
+                        quote = None
+                elif c in "'\"":
+                    quote = c
+                elif c == "{":
+                    depth += 1
+                    if depth == 1:
+                        start = p + 1
+                elif c == "}":
+                    depth -= 1
+                    if depth == 0:
+                        if text[start:p].strip():
+                            body.append(text[start:p])
+                        rest = text[p + 1:].strip()
+                        if rest:
+                            lines[i] = rest
+                        else:
+                            i += 1
+                        return self.compile_lines(self.split_statements("\n".join(body)), scope), i, rest
+                p += 1
+            if text[start:].strip():
+                body.append(text[start:])
+            i += 1
+            if i >= len(lines):
+                return self.compile_lines(self.split_statements("\n".join(body)), scope), i, ""
+            text = lines[i]
+            start = p = 0
+
+    def compile_lines(self, lines, scope):
+        lines = list(lines)
+        program = []
         i = 0
 
         while i < len(lines):
 
             line = lines[i].strip()
-            #print("JS LINE",line)
             if not line or line.startswith("//"):
                 i += 1
                 continue
@@ -176,258 +1463,159 @@ class SimpleJSInterpreter:
             # -------- alert definition --------
             m = re.match(r'alert\((.+?)\)', line)
             if m:
-                print("JS:", m.group(1))
-                tkinter.messagebox.showinfo("Alert", m.group(1))
+                program.append(("alert", self.expression(m.group(1), scope)))
                 i += 1
                 continue
 
-
             # -------- function definition --------
             m = re.match(r'function\s+(\w+)\s*\((.*?)\)\s*\{', line)
             if m:
-                fname = m.group(1)
-                args = m.group(2)
-                body = []
-                i += 1
-                brace_count = 1
-                while i < len(lines) and brace_count > 0:
-                    l = lines[i]
-                    brace_count += l.count("{")
-                    brace_count -= l.count("}")
-                    if brace_count > 0:
-                        body.append(l)
-                    i += 1
-                self.functions[fname] = ";".join(body)
+                params = [p.strip() for p in m.group(2).split(",") if p.strip()]
+                template, i, _ = self.compile_function(lines, i, scope, params)
+                program.append(("function", m.group(1), template))
                 continue
 
             # -------- function call --------
             m = re.match(r'(\w+)\s*\(\)', line)
-            if m and m.group(1) in self.functions:
-                self.run(self.functions[m.group(1)], tag_stack)
+            if m:
+                program.append(("call", m.group(1), self.expression(line, scope)))
                 i += 1
                 continue
 
             # -------- if statement --------
-            m = re.match(r'if\s*\((.*?)\)\s*\{', line)
+            # "else if" without a preceding if is run as a plain if
+            m = re.match(r'(?:else\s+)?if\s*\((.*?)\)\s*\{', line)
             if m:
-                condition = m.group(1)
-                block = []
-                i += 1
-                brace_count = 1
-                while i < len(lines) and brace_count > 0:
-                    l = lines[i]
-                    brace_count += l.count("{")
-                    brace_count -= l.count("}")
-                    if brace_count > 0:
-                        block.append(l)
-                    i += 1
-                if self.eval_condition(condition):
-                    self.run(";".join(block), tag_stack)
-                continue
-            
-            # -------- else if --------
-            m = re.match(r'else\s+if\s*\((.*?)\)\s*\{', line)
-            if m:
-                condition = m.group(1)
-                block = []
-                i += 1
-                brace_count = 1
-                while i < len(lines) and brace_count > 0:
-                    l = lines[i]
-                    brace_count += l.count("{")
-                    brace_count -= l.count("}")
-                    if brace_count > 0:
-                        block.append(l)
-                    i += 1
-                if self.eval_condition(condition):
-                    self.run(";".join(block), tag_stack)
+                condition = self.expression(m.group(1), scope)
+                block, i, _ = self.collect_block(lines, i, JSScope(scope))
+                branches = [(condition, block)]
+                else_block = None
+                while i < len(lines):
+                    follow = lines[i].strip()
+                    m = re.match(r'else\s+if\s*\((.*?)\)\s*\{', follow)
+                    if m:
+                        condition = self.expression(m.group(1), scope)
+                        block, i, _ = self.collect_block(lines, i, JSScope(scope))
+                        branches.append((condition, block))
+                        continue
+                    if re.match(r'else\s*\{', follow):
+                        else_block, i, _ = self.collect_block(lines, i, JSScope(scope))
+                    break
+                program.append(("if", tuple(branches), else_block))
                 continue
 
             # -------- for loop --------
             m = re.match(r'for\s*\((.+?);(.+?);(.+?)\)\s*\{', line)
             if m:
-                init = m.group(1)
-                cond = m.group(2)
-                incr = m.group(3)
-                
-                self.run(init)
-                
-                body = []
-                i += 1
-                brace_count = 1
-                while i < len(lines) and brace_count > 0:
-                    l = lines[i]
-                    brace_count += l.count("{")
-                    brace_count -= l.count("}")
-                    if brace_count > 0:
-                        body.append(l)
-                    i += 1
-                body_code = ";".join(body)
-                
-                count = 0
-                while self.eval_condition(cond) and count < 10000:
-                    self.run(body_code)
-                    self.run(incr)
-                    count += 1
+                loop_scope = JSScope(scope)
+                init = self.compile_lines(self.split_statements(m.group(1)), loop_scope)
+                cond = self.expression(m.group(2), loop_scope)
+                incr = self.compile_lines(self.split_statements(m.group(3)), loop_scope)
+                body, i, _ = self.collect_block(lines, i, JSScope(loop_scope))
+                program.append(("for", init, cond, incr, body))
                 continue
 
-            # -------- setInterval --------
-            m = re.match(r'setInterval\s*\(\s*function\s*\(\)\s*\{', line)
+            # -------- setInterval/setTimeout/requestAnimationFrame --------
+            m = re.match(r'(?:(var|let|const)\s+)?(?:(\w+)\s*=\s*)?(setInterval|setTimeout|requestAnimationFrame)\s*\(\s*function\s*\(([\w\s,]*)\)\s*\{', line)
             if m:
-                body = []
-                i += 1
-                while i < len(lines):
-                    l = lines[i].strip()
-                    if l.startswith("},"):
-                        break
-                    body.append(lines[i])
+                params = [p.strip() for p in m.group(4).split(",") if p.strip()]
+                template, i, rest = self.compile_function(lines, i, scope, params)
+                delay = None
+                if m.group(3) != "requestAnimationFrame":
+                    delay = self.expression("200" if m.group(3) == "setInterval" else "0", scope)
+                    delay_match = re.match(r',\s*(.+?)\s*\)\s*;?$', rest)
+                    if delay_match:
+                        delay = self.expression(delay_match.group(1), scope)
+                if rest:
                     i += 1
-
-                delay_match = re.search(r'\}\s*,\s*(\d+)\s*\)', lines[i])
-                delay = 200
-                if delay_match:
-                    delay = int(delay_match.group(1))
-
-                func_code = ";".join(body)
-                
-                def interval_func(code=func_code):
-                    #print("Running Func",code)
-                    self.run(code)
-                    if self.renderer and self.renderer.visualSystem and self.renderer.visualSystem.root:
-                         self.renderer.visualSystem.root.after(delay, interval_func)
-                
-                interval_func()
-                i += 1
+                store = None
+                if m.group(2):
+                    if m.group(1):
+                        scope.declare(m.group(2), m.group(1))
+                    store = build_js_store(m.group(2), scope)
+                program.append(("timer", m.group(3), template, delay, store))
                 continue
 
             # -------- addEventListener --------
-            m = re.match(r"document\.addEventListener\('keydown',\s*function\(event\)\s*\{", line)
+            m = re.match(r"document\.addEventListener\('keydown',\s*function\((\w*)\)\s*\{", line)
             if m:
-                 body = []
-                 i += 1
-                 while i < len(lines):
-                     if lines[i].strip().startswith("},"):
-                         break
-                     body.append(lines[i])
-                     i += 1
-
-                 func_code = ";".join(body)
-                 
-                 def on_key(event, code=func_code):
-                     js_keycode = 0
-                     if event.keysym == 'Left': js_keycode = 37
-                     elif event.keysym == 'Up': js_keycode = 38
-                     elif event.keysym == 'Right': js_keycode = 39
-                     elif event.keysym == 'Down': js_keycode = 40
-                     
-                     class Event:
-                         def __init__(self, code):
-                             self.keyCode = code
-                     
-                     self.vars['event'] = Event(js_keycode)
-                     self.run(code)
-                 
-                 if self.renderer and self.renderer.visualSystem and self.renderer.visualSystem.root:
-                     self.renderer.visualSystem.root.bind("<Key>", on_key)
-                     self.renderer.visualSystem.root.focus_set()
-                 
-                 i += 1
-                 continue
+                params = [m.group(1)] if m.group(1) else []
+                template, i, rest = self.compile_function(lines, i, scope, params)
+                if rest:
+                    i += 1
+                program.append(("keydown", template))
+                continue
 
             # -------- document.write --------
             m = re.match(r'document\.write\((.+?)\)', line)
             if m:
-                val = self.eval_value(m.group(1))
-                self.html_collection.addObject("text", {"content": str(val)}, tags=tag_stack)
+                program.append(("write", self.expression(m.group(1), scope)))
                 i += 1
                 continue
 
             # -------- console.log --------
             m = re.match(r'console\.log\((.+?)\)', line)
             if m:
-                print("JS:", self.eval_value(m.group(1)))
+                program.append(("log", self.expression(m.group(1), scope)))
                 i += 1
                 continue
 
             # -------- var/let/const assignment --------
             m = re.match(r'(var|let|const)\s+(\w+)\s*=\s*(.+)', line)
             if m:
-                self.vars[m.group(2)] = self.eval_value(m.group(3))
+                value = self.expression(m.group(3), scope)
+                scope.declare(m.group(2), m.group(1))
+                program.append(("assign", build_js_store(m.group(2), scope), value))
                 i += 1
                 continue
-            
+
             # -------- var/let/const declaration (no assignment) --------
             m = re.match(r'(var|let|const)\s+(\w+)', line)
             if m:
-                self.vars[m.group(2)] = ""
+                scope.declare(m.group(2), m.group(1))
+                program.append(("declare", build_js_store(m.group(2), scope)))
                 i += 1
                 continue
 
             # -------- Array pop --------
             m = re.match(r'let\s+(\w+)\s*=\s*(\w+)\.pop\(\)', line)
             if m:
-                target = m.group(1)
-                arr_name = m.group(2)
-                if arr_name in self.vars and isinstance(self.vars[arr_name], list):
-                    if self.vars[arr_name]:
-                        self.vars[target] = self.vars[arr_name].pop()
+                scope.declare(m.group(1))
+                program.append(("pop", build_js_store(m.group(1), scope), build_js_load(m.group(2), scope)))
                 i += 1
                 continue
 
             # -------- Array unshift --------
             m = re.match(r'(\w+)\.unshift\((.+)\)', line)
             if m:
-                arr_name = m.group(1)
-                val = m.group(2)
-                parsed_val = self.eval_value(val)
-                if arr_name in self.vars and isinstance(self.vars[arr_name], list):
-                    self.vars[arr_name].insert(0, parsed_val)
+                program.append(("unshift", build_js_load(m.group(1), scope), self.expression(m.group(2), scope)))
                 i += 1
                 continue
-            
+
             # -------- Array assignment board[i] = v --------
             m = re.match(r'(\w+)\[(.+)\]\s*=\s*(.+)', line)
             if m:
-                arr_name = m.group(1)
-                idx_expr = m.group(2)
-                val_expr = m.group(3)
-                if arr_name in self.vars:
-                    idx = self.eval_value(idx_expr)
-                    val = self.eval_value(val_expr)
-                    try:
-                        self.vars[arr_name][int(idx)] = val
-                    except:
-                        pass
+                program.append(("setindex", build_js_load(m.group(1), scope), self.expression(m.group(2), scope), self.expression(m.group(3), scope)))
                 i += 1
                 continue
 
             # -------- Assignment var = expr --------
             m = re.match(r'(\w+)\s*=\s*(.+)', line)
             if m:
-
-                var_name = m.group(1)
-                expr = m.group(2)
-                print(m.group(1),m.group(2))
-                self.vars[var_name] = self.eval_value(expr)
+                program.append(("assign", build_js_store(m.group(1), scope), self.expression(m.group(2), scope)))
                 i += 1
                 continue
-            # -------- Assignment let var = expr --------
-            m = re.match(r'let (\w+)\s*=\s*(.+)', line)
+            # -------- Compound assignment var += expr --------
+            m = re.match(r'(\w+)\s*([-+*/%])=\s*(.+)', line)
             if m:
-                print(m)
-                var_name = m.group(1)
-                expr = m.group(2)
-                self.vars[var_name] = self.eval_value(expr)
+                value = self.expression(f"{m.group(1)} {m.group(2)} ({m.group(3)})", scope)
+                program.append(("assign", build_js_store(m.group(1), scope), value))
                 i += 1
                 continue
             # -------- Increment/Decrement --------
             m = re.match(r'(\w+)(\+\+|--)', line)
             if m:
-                var = m.group(1)
-                op = m.group(2)
-                if var in self.vars:
-                    if op == "++": self.vars[var] += 1
-                    else: self.vars[var] -= 1
+                program.append(("incr", build_js_load(m.group(1), scope), build_js_store(m.group(1), scope), 1 if m.group(2) == "++" else -1))
                 i += 1
                 continue
 
@@ -437,159 +1625,281 @@ class SimpleJSInterpreter:
             if m:
                 #document.getElementById(id)
                 if m.group(1) == "getElementById":
-                    element = None
-                    #print(m.group(1),m.group(2))
-                    #print(self.html_collection.elements)
                     targetId = m.group(2)
                     if targetId[0] == "'" and targetId[-1] == "'":
                         targetId = targetId[1:-1]
                     elif targetId[0] == '"' and targetId[-1] == '"':
                         targetId = targetId[1:-1]
-                    #print(targetId)
-                    for item in self.html_collection.elements:
-                        #print(item.id,targetId)
-                        if item.id == targetId:
-                            element = item
-                            break
-                    #print(m.group(3))
                     if m.group(3) == "onclick":
-                        body = []
-                        i += 1
-                        brace_count = 1
-                        while i < len(lines) and brace_count > 0:
-                            l = lines[i]
-                            brace_count += l.count("{")
-                            brace_count -= l.count("}")
-                            if brace_count > 0:
-                                body.append(l)
+                        template, i, rest = self.compile_function(lines, i, scope)
+                        if rest:
                             i += 1
-                        func = ";".join(body)
-                        if element is not None:
-                            element.onclick = func
-                        continue
-                    if m.group(3) == "innerText":
-                        if element is not None:
-                            text = line.split("=",1)
-                            text = text[1]
-                            text  = self.eval_value(text)
-                            element.JSOveride["innerText"] =text
-                            if element.boundObject is not None:
-                                element.boundObject.configure(text_content=text)
-                        i+=1
-                        continue
-                    if m.group(3) == "innerHTML":
-                        if element is not None:
-                            text = line.split("=",1)
-                            text = text[1]
-                            text  = self.eval_value(text)
-                            element.JSOveride["innerHTML"] =text
-                            element.boundObject.configure(text_content=text)
-                        i+=1
+                        program.append(("onclick", targetId, template))
                         continue
-                    if m.group(3) == "outerHTML":
-                        if element is not None:
-                            text = line.split("=",1)
-                            text = text[1]
-                            text  = self.eval_value(text)
-                            
-                            if self.renderer:
-                                temp_renderer = self.renderer.__class__(self.renderer.visualSystem)
-                                temp_renderer.css_rules = self.renderer.css_rules
-                                temp_renderer.tag_styles = self.renderer.tag_styles.copy()
-                                temp_renderer.js.vars = self.vars
-                                temp_renderer.js.functions = self.functions
-                                temp_renderer.feed(text)
-                                new_elements = temp_renderer.htmlCollection.elements
-                                self.renderer.tag_styles.update(temp_renderer.tag_styles)
-                                
-                                if element in self.html_collection.elements:
-                                    idx = self.html_collection.elements.index(element)
-                                    self.html_collection.elements[idx:idx+1] = new_elements
-                                    
-                                    if element.boundObject:
-                                        content_frame = element.boundObject.master.master
-                                        for widget in content_frame.winfo_children():
-                                            widget.destroy()
-                                        RenderCSS(self.renderer, content_frame, self.renderer.visualSystem)
-                        i+=1
+                    if m.group(3) in ("innerText", "innerHTML", "outerHTML"):
+                        program.append((m.group(3), targetId, self.expression(line.split("=", 1)[1], scope)))
+                        i += 1
                         continue
 
-                    #
-
-
-            print("JS error:", line,type="error")
+            # -------- Expression statement, e.g. snake.push(head) --------
+            try:
+                program.append(("expr", build_js_expression(JSExpressionParser(line).parse(), scope), line))
+            except JSSyntaxError:
+                program.append(("error", line))
             i += 1
+        return tuple(program)
+
+    # ---------- evaluator ----------
+    def getElementById(self, targetId):
+        return self.html_collection.getElementById(targetId)
+
+    def call_value(self, func, args):
+        if isinstance(func, JSFunction):
+            self.execute(func.block, func.new_frame(args), [])
+            return None
+        if not callable(func):
+            raise TypeError(f"{js_to_string(func)} is not a function")
+        return func(*args)
+
+    def call_function(self, name, args):
+        if name in self.functions:
+            return self.call_value(self.functions[name], args)
+        func = self.vars.get(name, self.builtins.get(name, JS_GLOBALS.get(name)))
+        if func is None:
+            raise TypeError(f"{name} is not a function")
+        return self.call_value(func, args)
+
+    def op_alert(self, node, env, tag_stack):
+        message = js_to_string(node[1](self, env))
+        visualSystem = self.renderer.visualSystem if self.renderer is not None else None
+        if visualSystem is not None:
+            visualSystem.Alert(message)
+        else:
+            print("JS:", message)
 
-    def eval_value(self, val):
-        val = val.strip()
-        if val.startswith(("'", '"')) and val.endswith(("'", '"')):
-            return val[1:-1]
-        if val.isdigit():
-            return int(val)
-        if val == "true":
-            return True
-        if val == "false":
-            return False
-        
-        if "new Array" in val:
-             m = re.match(r'new\s+Array\((.+)\)\.fill\((.+)\)', val)
-             if m:
-                 size = self.eval_value(m.group(1))
-                 fill = self.eval_value(m.group(2))
-                 return [fill] * size
-        
-        if val.startswith("{") and val.endswith("}"):
-            val = re.sub(r'(\w+):', r"'\1':", val)
-        
-        val = re.sub(r'\.x\b', "['x']", val)
-        val = re.sub(r'\.y\b', "['y']", val)
-
-        if True in [x in val for x in list("+-/*")]:
-                #Replace variables
-                if True in [x in val for x in ["'", '"']]:
-                    operationType = "string"
-                else:
-                    operationType = "number"
-                for var_name, var_value in self.vars.items():
-                    #Determine the type of operation
+    def op_function(self, node, env, tag_stack):
+        self.functions[node[1]] = node[2].bind(env)
 
-                    if operationType == "string":
-                        var_value = f"str({var_value})"
-                    elif operationType == "number":
-                        var_value = f"{var_value}"
-                    
-                    val = re.sub(r'\b' + re.escape(var_name) + r'\b', str(var_value), val)
+    def op_call(self, node, env, tag_stack):
+        func = self.functions.get(node[1])
+        if func is not None:
+            self.execute(func.block, func.new_frame(), tag_stack)
+        else:
+            node[2](self, env)
+
+    def op_if(self, node, env, tag_stack):
+        for condition, block in node[1]:
+            if js_truthy(condition(self, env)):
+                self.execute(block, env, tag_stack)
+                return
+        if node[2] is not None:
+            self.execute(node[2], env, tag_stack)
+
+    def op_for(self, node, env, tag_stack):
+        _, init, cond, incr, body = node
+        self.execute(init, env, [])
+        count = 0
+        while js_truthy(cond(self, env)) and count < 10000:
+            self.execute(body, env, [])
+            self.execute(incr, env, [])
+            count += 1
+
+    def op_timer(self, node, env, tag_stack):
+        _, kind, template, delay, store = node
+        func = template.bind(env)
+        if kind == "requestAnimationFrame":
+            timer_id = self.loop.requestAnimationFrame(func)
+        else:
+            timer_id = self.builtins[kind](func, delay(self, env))
+        if store is not None:
+            store(self, env, timer_id)
+
+    def op_keydown(self, node, env, tag_stack):
+        func = node[1].bind(env)
+
+        def on_key(event):
+            js_keycode = 0
+            if event.keysym == 'Left': js_keycode = 37
+            elif event.keysym == 'Up': js_keycode = 38
+            elif event.keysym == 'Right': js_keycode = 39
+            elif event.keysym == 'Down': js_keycode = 40
+
+            self.run(func, args=({"keyCode": js_keycode},))
+
+        self.key_handler = on_key
+        if self.loop.root is not None:
+            self.key_binding = self.loop.root.bind("<Key>", on_key)
+            self.loop.root.focus_set()
+
+    def teardown(self):
+        # Stops everything a page left running once it is navigated away from
+        self.loop.stop()
+        self.pending_patches.clear()
+        if self.key_binding is not None:
+            self.loop.root.unbind("<Key>", self.key_binding)
+            self.key_binding = None
+
+    def pause(self):
+        # Freezes the page while it waits in the back/forward cache
+        self.loop.pause()
+        if self.key_binding is not None:
+            self.loop.root.unbind("<Key>", self.key_binding)
+            self.key_binding = None
+
+    def resume(self):
+        if self.key_handler is not None and self.loop.root is not None:
+            self.key_binding = self.loop.root.bind("<Key>", self.key_handler)
+        self.loop.resume()
+
+    def op_write(self, node, env, tag_stack):
+        self.document_write(node[1](self, env), tag_stack)
+
+    def document_write(self, val, tag_stack):
+        if self.write_at is not None:
+            index, parent = self.write_at
+            self.html_collection.insertObject(index, "text", {"content": js_to_string(val)}, tags=tag_stack, parent=parent)
+            self.write_at = (index + 1, parent)
+            return
+        parent = None
+        if self.renderer is not None and self.renderer.tag_stack:
+            parent = self.renderer.tag_stack[-1][3]
+        self.html_collection.addObject("text", {"content": js_to_string(val)}, tags=tag_stack, parent=parent)
+
+    def op_log(self, node, env, tag_stack):
+        print("JS:", js_to_string(node[1](self, env)))
+
+    def op_declare(self, node, env, tag_stack):
+        node[1](self, env, "")
+
+    def op_pop(self, node, env, tag_stack):
+        arr = node[2](self, env)
+        if isinstance(arr, list) and arr:
+            node[1](self, env, arr.pop())
+
+    def op_unshift(self, node, env, tag_stack):
+        arr = node[1](self, env)
+        parsed_val = node[2](self, env)
+        if isinstance(arr, list):
+            arr.insert(0, parsed_val)
+
+    def op_setindex(self, node, env, tag_stack):
+        arr = node[1](self, env)
+        if arr != "":
+            idx = node[2](self, env)
+            val = node[3](self, env)
+            try:
+                js_set_index(arr, idx, val)
+            except (TypeError, ValueError):
+                pass
 
+    def op_assign(self, node, env, tag_stack):
+        node[1](self, env, node[2](self, env))
 
+    def op_incr(self, node, env, tag_stack):
+        node[2](self, env, js_to_number(node[1](self, env)) + node[3])
 
-                #print(val)
-                try:
-                    return eval(val)
-                except Exception as e:
-                    print("Evaluation Error:",e,type = "error")
-                    return val
-
-        return self.vars.get(val, "")
-
-    def eval_condition(self, cond):
-        cond = re.sub(r'\.x\b', "['x']", cond)
-        cond = re.sub(r'\.y\b', "['y']", cond)
-        
-        for var_name, var_value in self.vars.items():
-             cond = re.sub(r'\b' + re.escape(var_name) + r'\b', str(var_value), cond)
-        
+    def op_expr(self, node, env, tag_stack):
         try:
-            return eval(cond)
-        except:
-            return False
+            node[1](self, env)
+        except Exception as e:
+            print("JS error:", node[2], e, type="error")
+
+    def op_onclick(self, node, env, tag_stack):
+        element = self.getElementById(node[1])
+        if element is not None:
+            element.onclick = node[2].bind(env)
+
+    def op_inner_text(self, node, env, tag_stack):
+        element = self.getElementById(node[1])
+        if element is not None:
+            self.set_text(element, "innerText", js_to_string(node[2](self, env)))
+
+    def op_inner_html(self, node, env, tag_stack):
+        element = self.getElementById(node[1])
+        if element is not None:
+            self.set_text(element, "innerHTML", js_to_string(node[2](self, env)))
+
+    def set_text(self, element, key, text):
+        # Kept on the element for whatever draws it next (the last write
+        # wins), and sent to whatever shows it now
+        overrides = element.JSOveride
+        overrides.pop("innerHTML" if key == "innerText" else "innerText", None)
+        overrides[key] = text
+        canvasView = self.renderer.canvasView if self.renderer is not None else None
+        if element.boundObject is None and canvasView is not None:
+            # Not drawn yet on a canvas that only draws what's in view, but
+            # its layout still changes
+            element.boundObject = CanvasRun(canvasView, element)
+        if element.boundObject is not None:
+            self.loop.queue_dom_write((element, "text"), lambda: element.boundObject.configure(text_content=text))
+
+    def op_outer_html(self, node, env, tag_stack):
+        element = self.getElementById(node[1])
+        if element is None:
+            return
+        text = js_to_string(node[2](self, env))
+
+        if self.renderer:
+            temp_renderer = self.renderer.__class__(self.renderer.visualSystem)
+            temp_renderer.css_rules = self.renderer.css_rules
+            temp_renderer.js.vars = self.vars
+            temp_renderer.js.functions = self.functions
+            temp_renderer.js.loop = self.loop
+            temp_renderer.js.builtins = self.builtins
+            temp_renderer.url = self.renderer.url
+            temp_renderer.resources = self.renderer.resources
+            temp_renderer.canvasView = self.renderer.canvasView
+            # Styled as if parsed in element's place
+            temp_renderer.context = self.renderer.ancestorsOf(element)
+            if element.parent is not None and element.parent.tags:
+                temp_renderer.context_style = element.parent.tags[-1]
+            temp_renderer.feed(text)
+            new_elements = temp_renderer.htmlCollection.elements
+
+            if self.html_collection.contains(element):
+                removed = self.html_collection.replaceObject(element, new_elements)
+
+                patch = self.pending_patches.get(element)
+                if patch is not None:
+                    # Replacing content an earlier patch this frame put in:
+                    # fold it into that patch instead of patching twice
+                    idx = patch[1].index(element)
+                    patch[1][idx:idx + len(removed)] = new_elements
+                    for old_element in removed:
+                        self.pending_patches.pop(old_element, None)
+                elif self.renderer.content_frame is not None:
+                    patch = [removed, list(new_elements)]
+                    self.loop.queue_dom_write(("outerHTML", element), lambda: self.apply_patch(patch))
+                else:
+                    return
+                for new_element in new_elements:
+                    self.pending_patches[new_element] = patch
+
+    def apply_patch(self, patch):
+        removed, new_elements = patch
+        for new_element in new_elements:
+            self.pending_patches.pop(new_element, None)
+        if self.renderer.canvasView is not None:
+            self.renderer.canvasView.patch(removed, new_elements)
+        else:
+            PatchCSS(self.renderer, removed, new_elements, self.renderer.visualSystem)
+
+    def op_error(self, node, env, tag_stack):
+        print("JS error:", node[1], type="error")
 
     def split_statements(self, code):
         all_stmts = []
         for line in code.splitlines():
             stmts, buf, depth = [], "", 0
             paren_depth = 0
+            quote = None
             for c in line:
-                if c == "{":
+                if quote:
+                    if c == quote and not buf.endswith("\\"):
+                        quote = None
+                elif c in "'\"":
+                    quote = c
+                elif c == "{":
                     depth += 1
                 elif c == "}":
                     depth -= 1
@@ -598,7 +1908,7 @@ class SimpleJSInterpreter:
                 elif c == ")":
                     paren_depth -= 1
                 
-                if c == ";" and depth == 0 and paren_depth == 0:
+                if c == ";" and depth == 0 and paren_depth == 0 and not quote:
                     if buf.strip():
                         stmts.append(buf.strip())
                     buf = ""
@@ -613,10 +1923,16 @@ class SimpleJSInterpreter:
 # ================== VISUAL SYSTEM ==============
 
 class VISUALSYSTEM:
-    def __init__(self,root = None, outline = False):
-        self.objects = []
+    images = True  # whether pages fetch and show images
+
+    def __init__(self,root = None, outline = False, backend = "widgets"):
+        # Insertion ordered, so a single widget can be dropped in O(1)
+        self.objects = {}
         self.root = root
         self.outline = outline
+        # "widgets" renders with RenderCSS, "canvas" with RenderCanvas
+        self.backend = backend
+        self.page = None
 
     def _create(self, cls, *args, **kwargs):
         if not args and "master" not in kwargs:
@@ -625,7 +1941,7 @@ class VISUALSYSTEM:
             kwargs["highlightbackground"] = "red"
             kwargs["highlightthickness"] = 1
         obj = cls(*args, **kwargs)
-        self.objects.append(obj)
+        self.objects[obj] = None
         return obj
 
     def Button(self,*args,**kwargs):
@@ -637,20 +1953,504 @@ class VISUALSYSTEM:
     def Label(self,*args,**kwargs):
         return self._create(tk.Label, *args, **kwargs)
 
+    def TransparentLabel(self, *args, **kwargs):
+        return self._create(TransparentLabel, *args, **kwargs)
+
     def Frame(self, *args,**kwargs):
         return self._create(tk.Frame, *args, **kwargs)
 
+    def Canvas(self, *args, **kwargs):
+        return self._create(tk.Canvas, *args, **kwargs)
+
+    def Scrollbar(self, *args, **kwargs):
+        return self._create(tk.Scrollbar, *args, **kwargs)
+
     def PhotoImage(self, *args, **kwargs):
         return tk.PhotoImage(*args, **kwargs)
 
+    def Alert(self, message):
+        print("JS:", message)
+        if self.root is not None:
+            tkinter.messagebox.showinfo("Alert", message, parent=self.root)
+        else:
+            tkinter.messagebox.showinfo("Alert", message)
+
+    def destroy(self, obj):
+        # Destroys one widget and forgets it and its children
+        stack = [obj]
+        while stack:
+            widget = stack.pop()
+            self.objects.pop(widget, None)
+            stack.extend(widget.winfo_children())
+        obj.destroy()
+
+    def detach(self, obj):
+        # Forgets a widget and its children without destroying them, so
+        # clear() leaves them alone; attach() takes them back
+        detached = []
+        stack = [obj]
+        while stack:
+            widget = stack.pop()
+            if widget in self.objects:
+                del self.objects[widget]
+                detached.append(widget)
+            stack.extend(widget.winfo_children())
+        return detached
+
+    def attach(self, objects):
+        for obj in objects:
+            self.objects[obj] = None
+
     def clear(self):
         for obj in self.objects:
             try:
                 obj.destroy()
             except Exception:
                 pass
-        self.objects = []
+        self.objects = {}
+
+
+
+# ================== SELECTORS ==================
+
+SELECTOR_TOKEN = re.compile(r"""
+    \s*(?P<combinator>[>+~])\s*
+  | (?P<space>\s+)
+  | (?P<simple>[#.]?-?[_a-zA-Z][\w-]*|\*)
+  | \[\s*(?P<attr>[\w-]+)\s*(?:=\s*(?P<value>"[^"]*"|'[^']*'|[^\]\s]*)\s*)?\]
+""", re.X)
+
 
+class Compound:
+    # One compound selector, e.g. div#main.note[title]: everything must match
+    # the same element
+    __slots__ = ("tag", "id", "classes", "attrs")
+
+    def __init__(self):
+        self.tag = None
+        self.id = None
+        self.classes = ()
+        self.attrs = ()  # (name, value or None for just present)
+
+    def matches(self, tag, attrs):
+        if self.tag is not None and self.tag != tag:
+            return False
+        if self.id is not None and attrs.get("id") != self.id:
+            return False
+        if self.classes:
+            classes = attrs.get("class", "").split()
+            for name in self.classes:
+                if name not in classes:
+                    return False
+        for name, value in self.attrs:
+            if name not in attrs or (value is not None and attrs[name] != value):
+                return False
+        return True
+
+    def key(self):
+        # The id, first class or tag it needs, spelled like a rule key
+        if self.id is not None:
+            return "#" + self.id
+        if self.classes:
+            return "." + self.classes[0]
+        return self.tag
+
+
+class Selector:
+    # A parsed complex selector, compounds kept right to left with the
+    # combinator (" " or ">") joining each to the one after it
+    __slots__ = ("compounds", "combinators", "specificity")
+
+    def __init__(self, compounds, combinators):
+        self.compounds = compounds
+        self.combinators = combinators
+        ids = classes = tags = 0
+        for compound in compounds:
+            ids += compound.id is not None
+            classes += len(compound.classes) + len(compound.attrs)
+            tags += compound.tag is not None
+        self.specificity = (ids, classes, tags)
+
+    @classmethod
+    def parse(cls, text):
+        # None for anything unsupported (sibling combinators, pseudo-classes),
+        # which like in browsers drops the rule instead of over-matching
+        compounds = [Compound()]
+        combinators = []
+        empty = True
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            match = SELECTOR_TOKEN.match(text, position)
+            if match is None:
+                return None
+            position = match.end()
+            if match.group("combinator") or match.group("space"):
+                combinator = match.group("combinator") or " "
+                if empty or combinator not in (" ", ">"):
+                    return None
+                compounds.append(Compound())
+                combinators.append(combinator)
+                empty = True
+                continue
+            compound = compounds[-1]
+            simple = match.group("simple")
+            if simple is not None:
+                if simple[0] == "#":
+                    compound.id = simple[1:]
+                elif simple[0] == ".":
+                    compound.classes += (simple[1:],)
+                elif simple != "*":
+                    compound.tag = simple.lower()
+            else:
+                value = match.group("value")
+                if value is not None and value[:1] in ("'", '"'):
+                    value = value[1:-1]
+                compound.attrs += ((match.group("attr").lower(), value),)
+            empty = False
+        if empty:
+            return None
+        compounds.reverse()
+        combinators.reverse()
+        return cls(compounds, combinators)
+
+    def matches(self, tag, attrs, ancestors):
+        # ancestors are (tag, attrs, ...) entries, outermost first, like the
+        # renderer's tag_stack
+        return self.compounds[0].matches(tag, attrs) and self.matchAncestors(1, len(ancestors), ancestors)
+
+    def matchAncestors(self, index, end, ancestors):
+        # compounds[index:] against ancestors[:end]
+        if index == len(self.compounds):
+            return True
+        compound = self.compounds[index]
+        if self.combinators[index - 1] == ">":
+            if end == 0:
+                return False
+            entry = ancestors[end - 1]
+            return compound.matches(entry[0], entry[1]) and self.matchAncestors(index + 1, end - 1, ancestors)
+        for position in range(end - 1, -1, -1):
+            entry = ancestors[position]
+            if compound.matches(entry[0], entry[1]) and self.matchAncestors(index + 1, position, ancestors):
+                return True
+        return False
+
+
+class RuleSet:
+    # Style rules bucketed by the id, first class or tag of their rightmost
+    # compound, so an element is only matched against rules that could
+    # apply to it. Within a bucket, rules with an ancestor part are keyed
+    # again by what the nearest one needs, and only looked at when some
+    # ancestor has it. Rules are (sort key, selector, properties, serial),
+    # the key being specificity then source order and the serial that of
+    # the declaration block the properties came from.
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.by_id = {}
+        self.by_class = {}
+        self.by_tag = {}
+        self.universal = {}  # ancestor key (None if none) -> rules
+        self.count = 0
+        # Computed styles resolved against these rules, which go with them
+        self.root = ComputedStyle({})
+        self.interned = {}
+
+    def intern(self, props):
+        style = ComputedStyle(props)
+        return self.interned.setdefault(frozenset(props.items()), style)
+
+    def add(self, selector, props, serial=None):
+        if serial is None:
+            serial = next(DECLARATION_SERIALS)
+        rule = ((selector.specificity, self.count), selector, props, serial)
+        self.count += 1
+        subject = selector.compounds[0]
+        if subject.id is not None:
+            bucket = self.by_id.setdefault(subject.id, {})
+        elif subject.classes:
+            bucket = self.by_class.setdefault(subject.classes[0], {})
+        elif subject.tag is not None:
+            bucket = self.by_tag.setdefault(subject.tag, {})
+        else:
+            bucket = self.universal
+        ancestor = selector.compounds[1].key() if len(selector.compounds) > 1 else None
+        bucket.setdefault(ancestor, []).append(rule)
+
+    def addSheet(self, sheet):
+        for selector, props, serial in sheet:
+            self.add(selector, props, serial)
+
+    def ancestorKeys(self, ancestors):
+        keys = set()
+        for entry in ancestors:
+            keys.add(entry[0])
+            attrs = entry[1]
+            if "id" in attrs:
+                keys.add("#" + attrs["id"])
+            if "class" in attrs:
+                keys.update("." + name for name in attrs["class"].split())
+        return keys
+
+    def candidates(self, tag, attrs, ancestors):
+        buckets = [self.universal, self.by_tag.get(tag)]
+        if "id" in attrs:
+            buckets.append(self.by_id.get(attrs["id"]))
+        if "class" in attrs:
+            buckets += [self.by_class.get(name) for name in set(attrs["class"].split())]
+        rules = []
+        keys = None
+        for bucket in buckets:
+            if not bucket:
+                continue
+            rules += bucket.get(None, ())
+            if len(bucket) > (None in bucket):
+                if keys is None:
+                    keys = self.ancestorKeys(ancestors)
+                for key in keys:
+                    rules += bucket.get(key, ())
+        return rules
+
+    def match(self, tag, attrs, ancestors=()):
+        # Matching rules, lowest priority first
+        matched = [rule for rule in self.candidates(tag, attrs, ancestors) if rule[1].matches(tag, attrs, ancestors)]
+        matched.sort(key=lambda rule: rule[0])
+        return matched
+
+
+INHERITED_PROPERTIES = {"foreground", "font-family", "size", "weight", "font-style", "text-transform", "text-align",
+                        "line-height", "letter-spacing", "word-spacing", "white-space", "visibility", "cursor",
+                        "direction", "list-style", "list-style-type"}
+
+
+class ComputedStyle:
+    # An element's resolved properties. Never changed once made, so every
+    # element with the same parent style, matched rules and inline style
+    # shares one, found through its parent's children.
+    __slots__ = ("props", "children")
+
+    def __init__(self, props):
+        self.props = props
+        self.children = {}  # (matched rule keys, inline style) -> ComputedStyle
+
+    def get(self, name, default=None):
+        return self.props.get(name, default)
+
+    def __getitem__(self, name):
+        return self.props[name]
+
+    def __contains__(self, name):
+        return name in self.props
+
+    def items(self):
+        return self.props.items()
+
+    def inherited(self):
+        return {name: value for name, value in self.props.items() if name in INHERITED_PROPERTIES}
+
+
+# ================== CSS PARSER ==================
+
+CSS_TOKEN = re.compile(r"""
+    (?P<comment>/\*.*?(?:\*/|\Z))
+  | (?P<string>"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?)
+  | (?P<open>\{) | (?P<close>\}) | (?P<semicolon>;) | (?P<paren>[()])
+  | (?P<at>@[\w-]+)
+  | (?P<other>[^"'{};()@/]+|[@/])
+""", re.X | re.S)
+IMPORTANT = re.compile(r"\s*!\s*important$")
+MEDIA_WIDTH = 1024  # the viewport width @media queries are answered for
+# Numbers each parsed declaration block for good, unlike rule order or id()
+DECLARATION_SERIALS = itertools.count(1)
+
+
+def TokenizeCSS(css):
+    # (kind, text) pairs in one pass over css, comments dropped
+    for match in CSS_TOKEN.finditer(css):
+        if match.lastgroup != "comment":
+            yield match.lastgroup, match.group()
+
+
+def ParseRules(tokens, rules):
+    # Appends the (selector, properties, serial) rules up to the end of
+    # tokens or the } closing the block they're in
+    prelude = []
+    for kind, text in tokens:
+        if kind == "close":
+            return
+        if kind == "semicolon":
+            prelude = []  # @import, @charset, or junk before a rule
+            continue
+        if kind != "open":
+            prelude.append((kind, text))
+            continue
+        head = "".join(text for _, text in prelude).split(None, 1)
+        if head and head[0].startswith("@"):
+            name = head[0].lower()
+            if (name == "@media" and MediaMatches(head[1] if len(head) > 1 else "")) or name in ("@supports", "@layer"):
+                ParseRules(tokens, rules)
+            else:
+                SkipBlock(tokens)  # @font-face, @keyframes, @page...
+        else:
+            props = CSSProperties(ReadDeclarations(tokens))
+            serial = next(DECLARATION_SERIALS)
+            for selector_text in SplitSelectors(prelude):
+                selector = Selector.parse(selector_text)
+                if selector is not None:
+                    rules.append((selector, props, serial))
+        prelude = []
+
+
+def SkipBlock(tokens):
+    depth = 1
+    for kind, _ in tokens:
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def ReadDeclarations(tokens):
+    # A block's declarations up to its closing }, split on the semicolons
+    # that aren't inside strings or brackets like url(data:...;base64,...)
+    declarations = []
+    current = []
+    depth = 0
+    for kind, text in tokens:
+        if kind == "close":
+            break
+        if kind == "open":
+            SkipBlock(tokens)  # a nested rule
+            current = []
+            continue
+        if kind == "paren":
+            depth = depth + 1 if text == "(" else max(depth - 1, 0)
+        elif kind == "semicolon" and depth == 0:
+            declarations.append("".join(current))
+            current = []
+            continue
+        current.append(text)
+    declarations.append("".join(current))
+    return declarations
+
+
+def SplitSelectors(prelude):
+    # A selector list's selectors, split on the commas outside strings
+    selectors = []
+    current = []
+    for kind, text in prelude:
+        if kind == "other" and "," in text:
+            pieces = text.split(",")
+            current.append(pieces[0])
+            for piece in pieces[1:]:
+                selectors.append("".join(current))
+                current = [piece]
+        else:
+            current.append(text)
+    selectors.append("".join(current))
+    return selectors
+
+
+def MediaMatches(query):
+    # Media types and min/max-width are checked; other features are taken
+    # to hold
+    for part in query.lower().split(","):
+        words = part.split()
+        negate = words[:1] == ["not"]
+        if words[:1] in (["not"], ["only"]):
+            words = words[1:]
+        matched = not words or words[0].startswith("(") or words[0] in ("all", "screen")
+        for which, width in re.findall(r"\(\s*(min|max)-width\s*:\s*([\d.]+)px\s*\)", part):
+            if (which == "min" and MEDIA_WIDTH < float(width)) or (which == "max" and MEDIA_WIDTH > float(width)):
+                matched = False
+        if matched != negate:
+            return True
+    return False
+
+
+def CSSProperties(declarations):
+    # "name: value" declarations as the properties the renderers use
+    props = {}
+    for item in declarations:
+        if ":" not in item:
+            continue
+        k, v = [x.strip().lower() for x in item.split(":", 1)]
+        v = IMPORTANT.sub("", v)  # priority isn't tracked; the value still applies
+        if not v:
+            continue  # malformed, e.g. "font-family:"
+        if k == "color":
+            props["foreground"] = v
+        elif k == "background-color":
+            props["background"] = v
+        elif k == "font-weight":
+            weight = v
+            if weight == "lighter":
+                weight = "normal"
+            elif weight == "bolder":
+                weight = "bold"
+            elif weight.isdigit():
+                weight_val = int(weight)
+                if weight_val <= 500:
+                    weight = "normal"
+                else:
+                    weight = "bold"
+            props["weight"] = weight
+        elif k == "font-size":
+            size = re.sub(r"\D", "", v)
+            if size:
+                props["size"] = int(size)
+        elif k == "font-family":
+            # Again without lowercasing, as family names keep their case
+            v = IMPORTANT.sub("", item.split(":", 1)[1].strip())
+            rawdata = v.split(",")
+            font = rawdata.pop(0).strip()
+            if len(font) >= 2 and font[0] == font[-1] and font[0] in "'\"":
+                font = font[1:-1]
+            if not font:
+                continue  # e.g. "font-family: , serif"
+            data = tuple([font]+rawdata)
+            props["font-family"] = data
+        else:
+            props[k] = v
+    return props
+
+
+class _StylesheetCache:
+    # Parsed stylesheets keyed by a hash of their text, so the same CSS on
+    # another page, in another <style> or an outerHTML re-render isn't
+    # parsed again. The rule lists are shared and never changed.
+    max_entries = 128
+
+    def __init__(self):
+        self.sheets = OrderedDict()  # sha1 -> rules
+        self.lock = threading.Lock()
+
+    def parse(self, css):
+        # [(selector, properties)] in source order, a rule with a selector
+        # list giving one entry per selector
+        key = hashlib.sha1(css.encode("utf-8", errors="replace")).digest()
+        with self.lock:
+            rules = self.sheets.get(key)
+            if rules is not None:
+                self.sheets.move_to_end(key)
+                return rules
+        rules = []
+        ParseRules(TokenizeCSS(css), rules)
+        with self.lock:
+            self.sheets[key] = rules
+            while len(self.sheets) > self.max_entries:
+                self.sheets.popitem(last=False)
+        return rules
+
+    def clear(self):
+        with self.lock:
+            self.sheets.clear()
+
+
+Stylesheets = _StylesheetCache()
 
 
 # ================== HTML + CSS RENDERER ==================
@@ -659,9 +2459,13 @@ class AdvancedCSSRenderer(HTMLParser):
     def __init__(self, visualSystem=None):
         super().__init__()
         self.visualSystem = visualSystem
-        self.css_rules = {}
+        self.css_rules = RuleSet()
         self.tag_stack = []
-        self.tag_styles = {}
+        # For markup parsed into the middle of a page (outerHTML): the
+        # (tag, attrs) of the elements around it, outermost first, and the
+        # style it inherits
+        self.context = []
+        self.context_style = None
 
         self.in_style = False
         self.style_buffer = ""
@@ -671,47 +2475,75 @@ class AdvancedCSSRenderer(HTMLParser):
 
         self.htmlCollection = HTMLCollection()
         self.js = SimpleJSInterpreter(self.htmlCollection, self)
+        # The frame RenderCSS last drew the whole page into, and the frames
+        # PatchCSS drew replaced subtrees into (subtree root -> (frame, line))
+        self.content_frame = None
+        self.patch_frames = {}
+        # Set instead when the page is drawn by the canvas backend
+        self.canvasView = None
+        self.url = None
+        # The PageLoader still streaming this page in, if any. While one
+        # parses on its thread, scripts become "script" elements for it to
+        # run on the Tk thread instead of running in the parser.
+        self.loader = None
+        self.deferScripts = False
+        # The frame holding the whole page, and the history entry it was
+        # loaded for, so it can be kept in the back/forward cache
+        self.page_frame = None
+        self.historyIndex = None
+        # Parsed <style> and <link> sheets in document order; css_rules is
+        # them merged. Linked sheets are empty until they arrive.
+        self.style_sheets = []
+        self.resources = PageResources(self)
+        self.image_requests = {}  # (url, size) -> elements waiting on it
 
     def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
+        # Interned, so a big page keeps one copy of each tag and attribute name
+        tag = sys.intern(tag)
+        attrs = {sys.intern(name): value for name, value in attrs} if attrs else NO_ATTRS
 
         if tag == "style":
             self.in_style = True
             return
 
+        parent = self.tag_stack[-1][3] if self.tag_stack else None
+
         if tag == "script":
-            if "src" in attrs:
-                return  # ignore external JS safely
-            self.in_script = True
+            url = self.resourceURL(attrs.get("src"))
+            if url is not None:
+                self.requestScript(url, parent)
+            elif "src" not in attrs:
+                self.in_script = True
+            return
+
+        if tag == "link":
+            url = self.resourceURL(attrs.get("href"))
+            if url is not None and "stylesheet" in attrs.get("rel", "").lower().split():
+                self.requestStylesheet(url, attrs, parent)
             return
 
         if tag == "img":
             src = attrs.get("src")
             if src:
-                self.htmlCollection.addObject("image", {"src": src}, element_id=attrs.get("id"))
+                element = self.htmlCollection.addObject("image", {"src": src, "attrs": attrs}, element_id=attrs.get("id"), parent=parent)
+                url = self.resourceURL(src)
+                if url is not None:
+                    self.requestImage(url, element)
             return
 
         if tag == "br":
-            self.htmlCollection.addObject("br")
+            self.htmlCollection.addObject("br", parent=parent)
             return
 
         if tag == "span":
             pass
 
-        styles = {}
-        styles.update(self.css_rules.get(tag, {}))
-        if "class" in attrs:
-            styles.update(self.css_rules.get("." + attrs["class"], {}))
-        if "id" in attrs:
-            styles.update(self.css_rules.get("#" + attrs["id"], {}))
-        styles.update(self.parse_css_block(attrs.get("style", "")))
-
-        style_tag_name = f"style_{len(self.tag_styles)}"
-        self.tag_styles[style_tag_name] = styles
+        ancestors = self.context + self.tag_stack if self.context else self.tag_stack
+        style = self.styleFor(tag, attrs, ancestors, self.tag_stack[-1][2] if self.tag_stack else self.context_style)
 
-        # Push the tag, its attributes, and its generated style name to the stack
-        current_element = self.htmlCollection.addObject(tag, {"attrs": attrs}, tags=[style_tag_name], element_id=attrs.get("id"))
-        self.tag_stack.append((tag, attrs, style_tag_name, current_element))
+        # Push the tag, its attributes, and its computed style to the stack
+        current_element = self.htmlCollection.addObject(tag, {"attrs": attrs}, tags=(style,), element_id=attrs.get("id"), parent=parent)
+        self.tag_stack.append((tag, attrs, style, current_element))
 
 
     def handle_endtag(self, tag):
@@ -722,17 +2554,24 @@ class AdvancedCSSRenderer(HTMLParser):
             return
 
         if tag == "script":
+            if not self.in_script:
+                return  # an external script, already requested
             self.in_script = False
-            self.js.run(self.script_buffer, [s for _, _, s, _ in self.tag_stack])
+            style_tags = tuple(s for _, _, s, _ in self.tag_stack)
+            if self.deferScripts:
+                parent = self.tag_stack[-1][3] if self.tag_stack else None
+                self.htmlCollection.addObject("script", {"code": self.script_buffer}, tags=style_tags, parent=parent)
+            else:
+                self.js.run(self.script_buffer, style_tags)
             self.script_buffer = ""
             return
 
         if self.tag_stack and self.tag_stack[-1][0] == tag:
-            self.tag_stack.pop()
+            element = self.tag_stack.pop()[3]
             # Add an end marker for block-level elements to handle newlines
             if tag in {"p", "h1", "h2", "h3", "h4", "h5", "h6", "div", "li", "button"}:
 
-                self.htmlCollection.addObject(f"end_{tag}")
+                self.htmlCollection.addObject(sys.intern(f"end_{tag}"), parent=element)
 
 
     def handle_data(self, data):
@@ -743,8 +2582,6 @@ class AdvancedCSSRenderer(HTMLParser):
         elif self.tag_stack:
             # Get current tag info from the top of the stack
             tag, attrs, _, element = self.tag_stack[-1]
-            # Get all styles from the stack to handle nesting
-            style_tags = [s for _, _, s, _ in self.tag_stack]
 
             if data.strip():
                 if not element.data.get("content"):
@@ -752,98 +2589,257 @@ class AdvancedCSSRenderer(HTMLParser):
                 element.data["content"] += data.strip()
 
 
+    def runScript(self, element, index):
+        # Runs a deferred script element, with document.write output going
+        # in right after it rather than at the end of the document
+        self.js.write_at = (index + 1, element.parent)
+        try:
+            self.js.run(element.data["code"], element.tags)
+        except Exception as e:
+            print("JS error:", e, type="error")
+        finally:
+            self.js.write_at = None
+
+    def teardown(self):
+        # Stops all loading and scripting for a page being dropped
+        if self.loader is not None:
+            self.loader.cancel()
+        self.resources.cancel()
+        self.js.teardown()
+
+    # ---------- subresources ----------
+    def resourceURL(self, src):
+        # Absolute URL of a subresource, or None if it can't be resolved
+        if not src:
+            return None
+        if src.startswith("http://") or src.startswith("https://"):
+            return src
+        if self.url is None:
+            return None
+        return urllib.parse.urljoin(self.url, src)
+
+    def requestScript(self, url, parent):
+        style_tags = tuple(s for _, _, s, _ in self.tag_stack)
+        if self.deferScripts:
+            # Run in its place by the PageLoader, which waits for the code
+            element = self.htmlCollection.addObject("script", {"src": url, "code": None}, tags=style_tags, parent=parent)
+
+            def loaded(body, error):
+                element.data["code"] = body.decode("utf-8", errors="ignore") if body is not None else ""
+                if error is not None:
+                    print(f"Error loading script {url}: {error}", type="error")
+        else:
+            def loaded(body, error):
+                if error is not None:
+                    print(f"Error loading script {url}: {error}", type="error")
+                else:
+                    self.js.run(body.decode("utf-8", errors="ignore"), style_tags)
+        self.resources.request(url, loaded)
+
+    def requestStylesheet(self, url, attrs, parent):
+        # Elements after the link are held back from painting until it
+        # arrives, then restyled with it
+        element = self.htmlCollection.addObject("link", {"attrs": attrs, "sheet": len(self.style_sheets), "loaded": False}, parent=parent)
+        self.style_sheets.append([])
+
+        def loaded(body, error):
+            if error is not None:
+                print(f"Error loading stylesheet {url}: {error}", type="error")
+            else:
+                self.stylesheetLoaded(element, body.decode("utf-8", errors="ignore"))
+            element.data["loaded"] = True
+        self.resources.request(url, loaded)
+
+    def stylesheetLoaded(self, element, css):
+        self.style_sheets[element.data["sheet"]] = self.parse_stylesheet(css)
+        elements = self.htmlCollection.elements
+        try:
+            start = elements.index(element) + 1
+        except ValueError:
+            start = len(elements)
+        self.restyle(start)
+
+    def restyle(self, start=0):
+        # Rebuilds the rules from style_sheets and resolves the styles of the
+        # elements from index start on against them again
+        self.css_rules.clear()
+        for sheet in self.style_sheets:
+            self.css_rules.addSheet(sheet)
+
+        elements = self.htmlCollection.elements
+        for later in elements[start:]:
+            if not later.tags:
+                continue
+            # Parents come first, so theirs is already restyled
+            parent = later.parent.tags[-1] if later.parent is not None and later.parent.tags else None
+            attrs = later.data.get("attrs")
+            if attrs is not None:
+                later.tags = (self.styleFor(later.type, attrs, self.ancestorsOf(later), parent),)
+            elif parent is not None:
+                later.tags = (parent,)
+        # Still open elements pass their new style on to what's parsed next
+        self.tag_stack[:] = [(tag, attrs, element.tags[-1], element) for tag, attrs, _, element in self.tag_stack]
+
+    def requestImage(self, url, element):
+        if self.visualSystem is not None and not self.visualSystem.images:
+            return  # laid out by its width/height attributes only
+        key = (url, Images.requestedSize(element.data["attrs"]))
+        cached = Images.get(key)
+        if cached is not None:
+            # Already decoded at this size: painted with the image straight away
+            element.data["image"], element.data["image_size"] = cached
+            return
+        waiting = self.image_requests.get(key)
+        if waiting is not None:
+            waiting.append(element)
+            return
+        self.image_requests[key] = [element]
+        self.resources.request(url, lambda decoded, error: self.imageLoaded(key, decoded, error),
+                               prepare=lambda body: Images.decode(body, key[1]))
+
+    def imageLoaded(self, key, decoded, error):
+        image = None
+        if error is None:
+            try:
+                image = Images.photo(decoded, key[1], self.visualSystem)
+            except tk.TclError as e:
+                # Without Pillow, tk.PhotoImage only reads GIF, PNG and PPM/PGM
+                error = e
+            else:
+                Images.put(key, image)
+        for element in self.image_requests.pop(key, []):
+            if image is not None:
+                element.data["image"] = image
+                element.data["image_size"] = (image.width(), image.height())
+            else:
+                print(f"Error loading image {element.data.get('src')}: {error}", type="error")
+                element.data["image_error"] = str(error)
+            if self.canvasView is not None:
+                self.canvasView.imageLoaded(element)
+            elif element.boundObject is not None:
+                ShowImage(element, element.boundObject)
+
     # ---------- CSS ----------
+    def styleFor(self, tag, attrs, ancestors=(), parent=None):
+        # The shared computed style for an element inside one with style
+        # parent; only worked out again for a combination not seen before
+        rules = self.css_rules
+        if parent is None:
+            parent = rules.root
+        matched = rules.match(tag, attrs, ancestors)
+        # Rules are told apart by their declarations' serials, which stay
+        # the same when the rules are rebuilt for a late sheet; their
+        # numbering doesn't, and parents from before it keep their caches
+        key = (tag in TEXT_ELEMENTS_SIZE and tag, tuple(rule[3] for rule in matched), attrs.get("style"))
+        style = parent.children.get(key)
+        if style is None:
+            props = parent.inherited()
+            if tag in TEXT_ELEMENTS_SIZE:
+                props["size"] = TEXT_ELEMENTS_SIZE[tag]
+            for rule in matched:
+                props.update(rule[2])
+            props.update(self.parse_css_block(attrs.get("style", "")))
+            style = rules.intern(props)
+            parent.children[key] = style
+        return style
+
+    def ancestorsOf(self, element):
+        # (tag, attrs) of the elements element is inside, outermost first
+        ancestors = []
+        node = element.parent
+        while node is not None:
+            ancestors.append((node.type, node.data.get("attrs", {})))
+            node = node.parent
+        ancestors.reverse()
+        return ancestors
+
     def parse_global_css(self, css):
-        for sel, block in re.findall(r"([^{]+)\{([^}]+)\}", css):
-            self.css_rules[sel.strip()] = self.parse_css_block(block)
+        sheet = self.parse_stylesheet(css)
+        self.style_sheets.append(sheet)
+        self.css_rules.addSheet(sheet)
+
+    def parse_stylesheet(self, css):
+        return Stylesheets.parse(css)
 
     def parse_css_block(self, block):
-        props = {}
-        for item in block.split(";"):
-            if ":" not in item:
-                continue
-            k, v = [x.strip().lower() for x in item.split(":", 1)]
-            if k == "color":
-                props["foreground"] = v
-            elif k == "background-color":
-                props["background"] = v
-            elif k == "font-weight":
-                weight = v
-                if weight == "lighter":
-                    weight = "normal"
-                elif weight == "bolder":
-                    weight = "bold"
-                elif weight.isdigit():
-                    weight_val = int(weight)
-                    if weight_val <= 500:
-                        weight = "normal"
-                    else:
-                        weight = "bold"
-                props["weight"] = weight
-            elif k == "font-size":
-                size = re.sub(r"\D", "", v)
-                if size:
-                    props["size"] = int(size)
-            elif k == "font-family":
-                k, v = [x.strip() for x in item.split(":", 1)]
-                rawdata = v.split(",")
-                font = rawdata.pop(0)
-                if font[0] == "'" and font[-1] == "'":
-                    font = font[1:-1]
-                elif font[0] == '"' and font[-1] == '"':
-                    font = font[1:-1]
-                data = [font]+rawdata
-                #print(v,font)
-                props["font-family"] = data
-            else:
-                props[k] = v
-        return props
+        return CSSProperties(ReadDeclarations(TokenizeCSS(block)))
 
-def RenderCSS(cssrenderer,content_frame,visualSystem):
+BLOCK_ELEMENTS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "div", "li"}
+TEXT_ELEMENTS_SIZE = {"h1": 24, "h2": 20, "h3": 18, "h4": 16, "h5": 14, "h6": 12, "p": 10}
+
+
+def ResolveTextStyle(cssrenderer, element):
+    # Text, font tuple and computed style of a text element, shared by the
+    # widget and canvas renderers
+    content = element.text("None")
+
+    # The innermost style, which already has what it inherits
+    style = element.tags[-1] if element.tags else cssrenderer.css_rules.root
+
+    font_family = "Arial"  # Hardcoded for now
+    font_family = style.get("font-family", [font_family])[0]
+    font_weight = style.get("weight", "normal")
+    font_size = style.get("size", TEXT_ELEMENTS_SIZE.get(element.type, 12))
+
+    text_transform = style.get("text-transform", "none")
+
+    if text_transform == "uppercase":
+        content = content.upper()
+
+    elif text_transform == "lowercase":
+        content = content.lower()
+
+    elif text_transform == "capitalize":
+        content = content.capitalize()
+
+    return content, (font_family, font_size, font_weight), style
+
+
+def ShowImage(element, label):
+    # Puts a loaded image (or why it failed) on its label
+    if "image" in element.data:
+        label.config(image=element.data["image"], text="")
+        label.image = element.data["image"]  # Keep a reference!
+    elif "image_error" in element.data:
+        label.config(text=f"[Image: {element.data.get('src')},{element.data['image_error']}]", fg="red")
+
+
+def RenderCSS(cssrenderer,content_frame,visualSystem, elements=None, inline_container=None):
+    # Renders elements (the whole document by default) into content_frame.
+    # Passing the returned inline_container back in carries on its line.
+    if elements is None:
+        elements = cssrenderer.htmlCollection.elements
+        cssrenderer.content_frame = content_frame
+        cssrenderer.patch_frames.clear()
     # A frame to hold inline elements for a single "line"
-    inline_container = visualSystem.Frame(content_frame)
-    inline_container.pack(fill="x", anchor="w")
-    block_elements = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "div", "li"}
-    text_elements_size = {"h1": 24, "h2": 20, "h3": 18, "h4": 16, "h5": 14, "h6": 12, "p": 10}
-    for element in cssrenderer.htmlCollection.elements:
+    if inline_container is None:
+        inline_container = visualSystem.Frame(content_frame)
+        inline_container.pack(fill="x", anchor="w")
+    block_elements = BLOCK_ELEMENTS
+    for element in elements:
         try:
             # print(element.type,element.data)
             if element.type == "title" and element.data.get("content"):
-                root.title(element.data["content"])
+                if visualSystem.root is not None:
+                    visualSystem.root.title(element.data["content"])
 
             elif element.type.startswith("end_") and element.type[4:] in block_elements:
                 # End of a block, start a new line for subsequent elements
                 inline_container = visualSystem.Frame(content_frame)
                 inline_container.pack(fill="x", anchor="w")
+                element.boundObject = inline_container
 
             elif element.type == "br":
                 inline_container = visualSystem.Frame(content_frame)
                 inline_container.pack(fill="x", anchor="w")
+                element.boundObject = inline_container
 
             elif element.type == "image":
-
-                try:
-                    src = element.data.get("src")
-                    if src and False:
-                        image_url = createAbsoluteURL(url, src)
-                        # print(image_url)
-                        # with urllib.request.urlopen(image_url) as r:
-                        #
-                        #    image_data = r.read()
-
-                        image_b64 = base64.b64encode(image_data)
-                        image = visualSystem.PhotoImage(data=image_b64)
-
-                        label = visualSystem.Label(inline_container, image=image)
-                        label.image = image  # Keep a reference!
-                        label.pack(side="left", anchor="nw")
-                        element.boundObject = label
-                except Exception as e:
-                    # tk.PhotoImage can fail if the image format is not supported (e.g., JPEG, PNG)
-                    # It primarily supports GIF and PGM/PPM.
-                    print(f"Error loading image {src}: {e}")
-                    error_label = visualSystem.Label(inline_container, text=f"[Image: {src},{e}]", fg="red")
-                    error_label.pack(side="left", anchor="nw")
+                # Shows its alt text until the image arrives
+                label = visualSystem.Label(inline_container, text=element.data.get("attrs", {}).get("alt", ""))
+                ShowImage(element, label)
+                label.pack(side="left", anchor="nw")
+                element.boundObject = label
 
             elif element.type == "input":
                 input_type = element.data.get("attrs", {}).get("type", "text")
@@ -872,38 +2868,11 @@ def RenderCSS(cssrenderer,content_frame,visualSystem):
 
 
             elif element.data.get("content") or element.data.get("attrs", {}).get("id"):
-                content = element.data.get("content", "None")
-
-                style = {}
-                if element.tags:
-                    for tag_name in element.tags:
-                        if tag_name in cssrenderer.tag_styles:
-                            style.update(cssrenderer.tag_styles[tag_name])
-
-                font_family = "Arial"  # Hardcoded for now
-                font_family = style.get("font-family", [font_family])[0]
-                # print(font_family)
-                # print(style)
-                font_weight = style.get("weight", "normal")
-                font_size = style.get("size", text_elements_size.get(element.type, 12))
-
-                text_transform = style.get("text-transform", "none")
-
-                if text_transform == "uppercase":
-                    content = content.upper()
-
-                elif text_transform == "lowercase":
-                    content = content.lower()
-
-                elif text_transform == "capitalize":
-                    content = content.capitalize()
-
-                elif text_transform == "none":
-                    pass
+                content, font, style = ResolveTextStyle(cssrenderer, element)
 
                 widget_config = {
                     "text": content,
-                    "font": (font_family, font_size, font_weight),
+                    "font": font,
                     "fg": style.get("foreground", "black"),
                     "bg": style.get("background"),
                 }
@@ -926,7 +2895,7 @@ def RenderCSS(cssrenderer,content_frame,visualSystem):
                     element.boundObject = button
                     button.pack(side="left", anchor="nw")
                 else:
-                    label = TransparentLabel(inline_container, **widget_config)
+                    label = visualSystem.TransparentLabel(inline_container, **widget_config)
 
                     onclick_js = element.data.get("attrs", {}).get("onclick")
                     if element.onclick:
@@ -945,7 +2914,7 @@ def RenderCSS(cssrenderer,content_frame,visualSystem):
                             label.config(fg="blue", cursor="hand2", underline=True)
 
                             def make_callback(url_to_open):
-                                return lambda e: searchAndStack(createAbsoluteURL(url, url_to_open), root,visualSystem)
+                                return lambda e: searchAndStack(createAbsoluteURL(cssrenderer.url, url_to_open), visualSystem.root, visualSystem)
 
                             label.bind("<Button-1>", make_callback(link_url))
 
@@ -955,40 +2924,1591 @@ def RenderCSS(cssrenderer,content_frame,visualSystem):
         except Exception as e:
             print(e, type="error")
             visualSystem.Label(content_frame, text=f"Error: {e}", fg="red").pack(anchor="w")
+    return inline_container
+
+def PatchCSS(cssrenderer, removed, new_elements, visualSystem):
+    # Swaps the widgets of a replaced subtree for ones rendered from
+    # new_elements into a patch frame, leaving the rest of the page's widgets
+    # alone. The removed subtree's closing end marker keeps its line frame,
+    # since the content after the subtree lives in it.
+    owned = cssrenderer.patch_frames.pop(removed[0], None)
+    if owned is not None and owned[0].winfo_exists():
+        # The subtree is the whole content of an earlier patch frame: swap
+        # that frame out rather than nesting another one inside it
+        before, line = owned
+    else:
+        owned = None
+        anchor = None
+        for element in removed:
+            if element.boundObject is not None and element.boundObject.winfo_exists():
+                anchor = element
+                break
+
+        if anchor is None:
+            # Nothing of the old subtree is on screen to patch around
+            content_frame = cssrenderer.content_frame
+            for widget in content_frame.winfo_children():
+                visualSystem.destroy(widget)
+            RenderCSS(cssrenderer, content_frame, visualSystem)
+            return
+        before = anchor.boundObject
+        # A subtree starting with a line break gets a line of its own
+        line = anchor.type == "br" or anchor.type.startswith("end_")
+
+    patch_frame = visualSystem.Frame(before.master)
+    if line:
+        patch_frame.pack(fill="x", anchor="w", before=before)
+    else:
+        patch_frame.pack(side="left", anchor="nw", before=before)
+    RenderCSS(cssrenderer, patch_frame, visualSystem, new_elements)
+    if new_elements and new_elements[0].lastDescendant() is new_elements[-1]:
+        cssrenderer.patch_frames[new_elements[0]] = (patch_frame, line)
+
+    if owned is not None:
+        visualSystem.destroy(before)
+    closing = removed[-1] if removed[-1].type.startswith("end_") else None
+    for element in removed:
+        if owned is None and element is not closing and element.boundObject is not None:
+            visualSystem.destroy(element.boundObject)
+        element.boundObject = None
+        cssrenderer.patch_frames.pop(element, None)
+
+# ================== LAYOUT ==================
+
+TEXT_INPUT_TYPES = ("text", "password", "email", "search", "tel", "url")
+BUTTON_INPUT_TYPES = ("button", "submit", "reset")
+WIDGET_FONT = ("Arial", 10, "normal")
+
+
+class LayoutMetrics:
+    # Measures text with the shared Tk fonts
+    def measure(self, font, text):
+        return Fonts.fromTuple(font).measure(text)
+
+    def linespace(self, font):
+        return Fonts.fromTuple(font).linespace()
+
+    def widgetSize(self, text, font):
+        # Size given to an embedded entry (text is None) or button; the
+        # renderer makes the real widget fit it
+        if text is None:
+            return self.measure(font, "0") * 20 + 6, self.linespace(font) + 6
+        return self.measure(font, text) + 16, self.linespace(font) + 10
+
+
+class ApproxMetrics(LayoutMetrics):
+    # Estimates sizes from the point size alone, for laying out without a display
+    def measure(self, font, text):
+        return int(len(text) * font[1] * (0.66 if font[2] == "bold" else 0.6) + 0.5)
+
+    def linespace(self, font):
+        return int(font[1] * 1.6 + 0.5)
+
+
+class LayoutItem:
+    # One element's inline content, measured once: a text run, an embedded
+    # widget or a line break. Words are only measured if the run has to wrap.
+    def __init__(self, element, kind, text=None, font=None, style=None):
+        self.element = element
+        self.kind = kind
+        self.text = text
+        self.font = font
+        self.style = style or {}
+        self.width = 0
+        self.height = 0
+        self.words = None  # [(word, width)], trailing whitespace kept
+
+
+class LayoutBox:
+    # A positioned piece of an item; a wrapped text run has one per line
+    def __init__(self, item, index, text, x, y, width):
+        self.item = item
+        self.index = index
+        self.text = text
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = item.height
+
+
+class LineBox:
+    def __init__(self, y):
+        self.y = y
+        self.height = 0
+        self.boxes = []
+        self.align = "left"
+
+
+class Layout:
+    # A document flowed at one width: lines of boxes, top to bottom. It may
+    # be partial, covering the elements before next only.
+    def __init__(self, width, margin):
+        self.width = width
+        self.margin = margin
+        self.right = max(width - margin, margin + 1)
+        self.lines = []
+        self.tops = []  # y of each line, for bisecting
+        self.boxes = []
+        self.line = LineBox(margin)
+        self.x = margin
+        self.height = margin
+        self.next = 0
+        self.complete = False
+
+    def newLine(self):
+        line = self.line
+        if line.boxes:
+            if line.align in ("right", "center"):
+                shift = self.right - self.x
+                if line.align == "center":
+                    shift //= 2
+                for box in line.boxes:
+                    box.x += shift
+            self.lines.append(line)
+            self.tops.append(line.y)
+        self.height = line.y + line.height
+        self.line = LineBox(self.height)
+        self.x = self.margin
+
+    def place(self, item, index, text, width):
+        line = self.line
+        if not line.boxes:
+            line.align = item.style.get("text-align", "left")
+        box = LayoutBox(item, index, text, self.x, line.y, width)
+        line.boxes.append(box)
+        self.boxes.append(box)
+        self.x += width
+        line.height = max(line.height, item.height)
+
+    def fits(self, width):
+        return self.x + width <= self.right
+
+    def placeText(self, item, metrics):
+        if self.fits(item.width):
+            self.place(item, 0, item.text, item.width)
+            return
+        if self.line.boxes and self.margin + item.width <= self.right:
+            self.newLine()
+            self.place(item, 0, item.text, item.width)
+            return
+
+        # Wider than a line: break it between words
+        if item.words is None:
+            item.words = [(word, metrics.measure(item.font, word)) for word in re.findall(r"\S+\s*|\s+", item.text)]
+        index = 0
+        text = ""
+        width = 0
+        for word, word_width in item.words:
+            if not self.fits(width + word_width):
+                if text:
+                    self.place(item, index, text, width)
+                    index += 1
+                    text = ""
+                    width = 0
+                if self.line.boxes:
+                    self.newLine()
+            text += word
+            width += word_width
+        if text:
+            self.place(item, index, text, width)
+
+    def finish(self):
+        self.newLine()
+        self.complete = True
+
+    def boxesBetween(self, top, bottom):
+        # Boxes on the closed lines overlapping top..bottom
+        start = max(bisect.bisect_right(self.tops, top) - 1, 0)
+        for line in self.lines[start:]:
+            if line.y >= bottom:
+                break
+            if line.y + line.height > top:
+                yield from line.boxes
+
+
+class DocumentLayout:
+    # Turns a page's elements into positioned boxes without touching Tk.
+    # Elements are measured once into items; flow() only breaks lines, so
+    # laying out at a new width reuses every measurement. Flowing can stop
+    # partway down the page and pick up later, also after more elements
+    # have been appended.
+    margin = 8
+
+    def __init__(self, cssrenderer, metrics=None):
+        self.cssrenderer = cssrenderer
+        self.metrics = metrics or LayoutMetrics()
+        self.itemFor = {}  # element -> LayoutItem, None if it takes no space
+        self.flowed = None
+        # Elements past this many are not laid out yet (still loading)
+        self.limit = None
+
+    def invalidate(self):
+        self.itemFor = {}
+        self.flowed = None
+
+    def setText(self, element, text):
+        if element not in self.itemFor:
+            return  # not reached yet; it is measured when it is
+        self.flowed = None
+        item = self.itemFor.get(element)
+        if item is None:
+            self.itemFor.pop(element, None)
+        elif item.kind != "break":
+            item.text = text
+            self.measureItem(item)
+
+    def forget(self, elements):
+        # For elements taken out of the page, e.g. by an outerHTML patch;
+        # everything else keeps its measurements
+        for element in elements:
+            self.itemFor.pop(element, None)
+        self.flowed = None
+
+    def remeasure(self, element):
+        # For an element whose size changed, e.g. an image that arrived
+        if element in self.itemFor:
+            del self.itemFor[element]
+            self.flowed = None
+
+    def item(self, element):
+        if element in self.itemFor:
+            return self.itemFor[element]
+        try:
+            item = self.buildItem(element)
+        except Exception as e:
+            print(e, type="error")
+            item = None
+        self.itemFor[element] = item
+        return item
+
+    def buildItem(self, element):
+        kind = element.type
+        attrs = element.data.get("attrs", {})
+        if (kind.startswith("end_") and kind[4:] in BLOCK_ELEMENTS) or kind == "br":
+            return LayoutItem(element, "break")
+        if kind == "image":
+            size = element.data.get("image_size")
+            if size is None:
+                try:
+                    size = (int(attrs["width"]), int(attrs["height"]))
+                except (KeyError, ValueError):
+                    return None  # no room taken until it arrives
+            item = LayoutItem(element, "image")
+            item.width, item.height = size
+            return item
+        if kind == "title":
+            return None
+
+        if kind == "input":
+            input_type = attrs.get("type", "text")
+            if input_type in TEXT_INPUT_TYPES:
+                item = LayoutItem(element, "widget", None, WIDGET_FONT)
+            elif input_type in BUTTON_INPUT_TYPES:
+                item = LayoutItem(element, "widget", attrs.get("value", "Button"), WIDGET_FONT)
+            else:
+                return None
+        elif element.data.get("content") or attrs.get("id"):
+            content, font, style = ResolveTextStyle(self.cssrenderer, element)
+            item = LayoutItem(element, "widget" if kind == "button" else "text", content, font, style)
+        else:
+            return None
+        self.measureItem(item)
+        return item
+
+    def measureItem(self, item):
+        metrics = self.metrics
+        item.words = None
+        if item.kind == "text":
+            item.width = metrics.measure(item.font, item.text)
+            item.height = metrics.linespace(item.font)
+        elif item.kind == "widget":
+            item.width, item.height = metrics.widgetSize(item.text, item.font)
+
+    def flow(self, width, until=None):
+        # Lays the page out at width. With until, stops at the first line
+        # starting below it and returns the partial layout.
+        layout = self.flowed
+        if layout is None or layout.width != width:
+            layout = self.flowed = Layout(width, self.margin)
+        elements = self.cssrenderer.htmlCollection.elements
+        count = len(elements) if self.limit is None else min(self.limit, len(elements))
+        if layout.complete and layout.next >= count:
+            return layout
+        layout.complete = False
+
+        while layout.next < count:
+            if until is not None and not layout.line.boxes and layout.line.y > until:
+                return layout
+            item = self.item(elements[layout.next])
+            layout.next += 1
+            if item is None:
+                continue
+            if item.kind == "break":
+                layout.newLine()
+            elif item.kind == "text":
+                layout.placeText(item, self.metrics)
+            else:
+                if layout.line.boxes and not layout.fits(item.width):
+                    layout.newLine()
+                layout.place(item, 0, item.text, item.width)
+        layout.finish()
+        return layout
+
+
+# ================== CANVAS RENDERER ==================
+
+class CanvasRun:
+    # The boundObject of an element drawn on a CanvasView, so JS text
+    # updates reach the layout the way they reach widgets
+    def __init__(self, view, element):
+        self.view = view
+        self.element = element
+
+    def configure(self, **kwargs):
+        text = kwargs.get("text_content", kwargs.get("text"))
+        if text is not None:
+            self.view.setText(self.element, text)
+
+    config = configure
+
+
+class CanvasView:
+    # Draws a page's DocumentLayout as items on one scrollable canvas instead
+    # of a frame per line and a canvas widget per text node. Links and
+    # onclick handlers are found by hit-testing the item under the pointer.
+    # Only buttons and inputs are still real widgets, embedded as canvas
+    # windows sized by the layout. Resizes and text changes re-flow the
+    # layout and move the items already drawn.
+    #
+    # Only the part of the page around the viewport is laid out and drawn
+    # up front; the rest is laid out a chunk at a time after first paint.
+    # Items that scroll out of range are dropped or, for plain text, hidden
+    # and reused for text scrolling in.
+    overscan = 400
+    chunk = 2000
+    max_spare = 256
+
+    def __init__(self, cssrenderer, master, visualSystem):
+        self.cssrenderer = cssrenderer
+        self.visualSystem = visualSystem
+        self.canvas = visualSystem.Canvas(master, bg="white", highlightthickness=0)
+        self.scrollbar = visualSystem.Scrollbar(master, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self.onScroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", expand=True, fill="both")
+
+        self.layout = DocumentLayout(cssrenderer)
+        self.drawn = {}  # (element, fragment index) -> [items, text, x, y, width, kind]
+        self.widgets = {}  # element -> embedded widget
+        self.actions = {}  # canvas item -> callback
+        self.spare = []  # hidden text items to reuse
+        self.shown = (0, 0)  # canvas y range drawn
+        self.pending = None
+        self.width = 0
+
+        self.canvas.bind("<Button-1>", self.onClick)
+        self.canvas.bind("<Motion>", self.onMotion)
+        self.canvas.bind("<Configure>", self.onResize)
+        self.canvas.bind("<MouseWheel>", lambda e: self.canvas.yview_scroll(int(-e.delta / 120), "units"))
+        self.canvas.bind("<Button-4>", lambda e: self.canvas.yview_scroll(-1, "units"))
+        self.canvas.bind("<Button-5>", lambda e: self.canvas.yview_scroll(1, "units"))
+
+    # ---------- layout ----------
+    def render(self):
+        self.canvas.delete("all")
+        for widget in self.widgets.values():
+            self.visualSystem.destroy(widget)
+        self.drawn = {}
+        self.widgets = {}
+        self.actions = {}
+        self.spare = []
+
+        root = self.visualSystem.root
+        for element in self.cssrenderer.htmlCollection.getElementsByTagName("title"):
+            if element.data.get("content") and root is not None:
+                root.title(element.data["content"])
+
+        self.layout.invalidate()
+        self.reflow()
+
+    def reflow(self):
+        width = self.canvas.winfo_width()
+        if width <= 1:
+            width = self.canvas.winfo_reqwidth()
+        self.width = width
+        self.refresh()
+
+    def refresh(self):
+        # Lays out as far down as the viewport reaches and draws around it
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        top -= self.overscan
+        bottom += self.overscan
+        layout = self.layout.flow(self.width, bottom)
+        self.sync(layout, top, bottom)
+        self.shown = (top, bottom)
+        self.canvas.configure(scrollregion=(0, 0, self.width, layout.height + layout.margin))
+        if not layout.complete and self.pending is None:
+            self.pending = self.canvas.after(1, self.extend)
+
+    def extend(self):
+        # Lays out the next chunk of the page below what has been laid out
+        self.pending = None
+        flowed = self.layout.flowed
+        start = flowed.height if flowed is not None and flowed.width == self.width else 0
+        layout = self.layout.flow(self.width, start + self.chunk)
+        self.canvas.configure(scrollregion=(0, 0, self.width, layout.height + layout.margin))
+        if not layout.complete:
+            self.pending = self.canvas.after(1, self.extend)
+
+    def sync(self, layout, top, bottom):
+        # Brings the drawn range in line with layout, touching only the items
+        # of boxes that appeared, moved or changed text
+        boxes = {(box.item.element, box.index): box for box in layout.boxesBetween(top, bottom)}
+        # Erase first so the text items freed can be reused below
+        for key in [key for key in self.drawn if key not in boxes]:
+            self.erase(self.drawn.pop(key))
+        for key, box in boxes.items():
+            record = self.drawn.get(key)
+            if record is None:
+                self.drawn[key] = self.draw(box)
+            else:
+                self.update(record, box)
+
+    def draw(self, box):
+        item = box.item
+        element = item.element
+        if item.kind == "image":
+            image = element.data.get("image")
+            if image is not None:
+                items = [self.canvas.create_image(box.x, box.y, image=image, anchor="nw")]
+            else:
+                items = [self.canvas.create_rectangle(box.x, box.y, box.x + box.width, box.y + box.height, outline="gray")]
+            return [items, box.text, box.x, box.y, box.width, item.kind]
+        if item.kind == "widget":
+            widget = self.widgets.get(element)
+            if widget is None:
+                widget = self.widgets[element] = self.makeWidget(item)
+            items = [self.canvas.create_window(box.x, box.y, window=widget, anchor="nw",
+                                               width=box.width, height=box.height)]
+            if item.text is None:
+                element.boundObject = widget
+                return [items, box.text, box.x, box.y, box.width, item.kind]
+        else:
+            fg, underline, action = self.textStyle(item)
+            font = Fonts.fromTuple(item.font, underline)
+            items = []
+            if item.style.get("background"):
+                items.append(self.canvas.create_rectangle(box.x, box.y, box.x + box.width, box.y + box.height,
+                                                          fill=item.style["background"], outline=""))
+            if self.spare and not items:
+                text_item = self.spare.pop()
+                self.canvas.coords(text_item, box.x, box.y)
+                self.canvas.itemconfig(text_item, text=box.text, font=font, fill=fg, state="normal")
+            else:
+                text_item = self.canvas.create_text(box.x, box.y, text=box.text, font=font, fill=fg, anchor="nw")
+            items.append(text_item)
+            if action is not None:
+                for canvas_item in items:
+                    self.actions[canvas_item] = action
+        if not isinstance(element.boundObject, CanvasRun):
+            element.boundObject = CanvasRun(self, element)
+        return [items, box.text, box.x, box.y, box.width, item.kind]
+
+    def update(self, record, box):
+        items, text, x, y, width, kind = record
+        if text != box.text and box.item.kind == "text":
+            self.canvas.itemconfig(items[-1], text=box.text)
+        if (x, y, width) != (box.x, box.y, box.width):
+            if box.item.kind == "widget":
+                self.canvas.coords(items[0], box.x, box.y)
+                self.canvas.itemconfig(items[0], width=box.width, height=box.height)
+            elif box.item.kind == "image":
+                self.erase(record)
+                record[0] = self.draw(box)[0]
+            else:
+                if len(items) > 1:
+                    self.canvas.coords(items[0], box.x, box.y, box.x + box.width, box.y + box.height)
+                self.canvas.coords(items[-1], box.x, box.y)
+        record[1:5] = [box.text, box.x, box.y, box.width]
+
+    def erase(self, record):
+        items = record[0]
+        for canvas_item in items:
+            self.actions.pop(canvas_item, None)
+        if record[5] == "text" and len(items) == 1 and len(self.spare) < self.max_spare:
+            self.canvas.itemconfig(items[0], state="hidden")
+            self.spare.append(items[0])
+            return
+        for canvas_item in items:
+            self.canvas.delete(canvas_item)
+
+    def makeWidget(self, item):
+        cssrenderer = self.cssrenderer
+        element = item.element
+        attrs = element.data.get("attrs", {})
+        if item.text is None:
+            entry = self.visualSystem.Entry(self.canvas)
+            if attrs.get("type") == "password":
+                entry.config(show="*")
+            return entry
+
+        if element.type == "button":
+            button = self.visualSystem.Button(self.canvas, text=item.text, font=item.font,
+                                              fg=item.style.get("foreground", "black"))
+        else:
+            button = self.visualSystem.Button(self.canvas, text=item.text)
+        onclick_js = element.onclick or attrs.get("onclick")
+        if onclick_js:
+            button.config(command=lambda js_code=onclick_js: cssrenderer.js.run(js_code))
+        return button
+
+    def textStyle(self, item):
+        # Colour, underline and click action of a text run
+        cssrenderer = self.cssrenderer
+        visualSystem = self.visualSystem
+        element = item.element
+        attrs = element.data.get("attrs", {})
+        onclick_js = element.onclick or attrs.get("onclick")
+        if onclick_js:
+            return item.style.get("foreground", "black"), False, lambda: cssrenderer.js.run(onclick_js)
+        if element.type == "a" and attrs.get("href"):
+            href = attrs["href"]
+            return "blue", True, lambda: searchAndStack(createAbsoluteURL(cssrenderer.url, href), visualSystem.root, visualSystem)
+        return item.style.get("foreground", "black"), False, None
+
+    # ---------- updates ----------
+    def setText(self, element, text):
+        widget = self.widgets.get(element)
+        if widget is not None:
+            widget.config(text=text)
+        self.layout.setText(element, text)
+        self.reflow()
+
+    def imageLoaded(self, element):
+        # Swaps the placeholder for the image and makes room for it
+        for key in [key for key in self.drawn if key[0] is element]:
+            self.erase(self.drawn.pop(key))
+        self.layout.remeasure(element)
+        self.refresh()
+
+    def patch(self, removed, new_elements):
+        # Items of untouched elements are kept and moved into place
+        for element in removed:
+            widget = self.widgets.pop(element, None)
+            if widget is not None:
+                self.visualSystem.destroy(widget)
+        self.layout.forget(removed)
+        self.reflow()
+
+    # ---------- events ----------
+    def itemAction(self, event):
+        x = self.canvas.canvasx(event.x)
+        y = self.canvas.canvasy(event.y)
+        for item in reversed(self.canvas.find_overlapping(x, y, x, y)):
+            if item in self.actions:
+                return self.actions[item]
+        return None
+
+    def onClick(self, event):
+        action = self.itemAction(event)
+        if action is not None:
+            action()
+
+    def onMotion(self, event):
+        self.canvas.config(cursor="hand2" if self.itemAction(event) else "")
+
+    def onResize(self, event):
+        # Only line breaking re-runs; existing items are moved
+        if event.width != self.width:
+            self.reflow()
+        else:
+            self.refresh()
+
+    def onScroll(self, first, last):
+        self.scrollbar.set(first, last)
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        margin = self.overscan // 2
+        if top < self.shown[0] + margin or bottom > self.shown[1] - margin:
+            self.refresh()
+
+
+def RenderCanvas(cssrenderer, content_frame, visualSystem):
+    view = CanvasView(cssrenderer, content_frame, visualSystem)
+    cssrenderer.content_frame = content_frame
+    cssrenderer.canvasView = view
+    view.render()
+    return view
+
+# ================== NETWORK ==================
+
+ACCEPT_ENCODING = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+USER_AGENT = "Spifftech/1.0 PyBrowser/1"
+
+
+class HttpResponse:
+    # A response read off a pooled connection, decoded (gzip, deflate and,
+    # with the brotli module, br) as it is read. The connection goes back to
+    # the pool once the body has been read to the end.
+    def __init__(self, pool, key, conn, response, url, timing):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.timing = timing
+        self.finished = False
+        self.fromCache = False
+
+        encoding = (response.getheader("Content-Encoding") or "").strip().lower()
+        self.decoder = None
+        if encoding in ("gzip", "x-gzip", "deflate"):
+            # Takes zlib and gzip headers alike
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS | 32)
+            self.decode = self.decoder.decompress
+        elif encoding == "br" and brotli is not None:
+            self.decoder = brotli.Decompressor()
+            self.decode = self.decoder.process
+        else:
+            self.decode = bytes
+
+    def read(self, n=-1):
+        if self.finished:
+            return b""
+        if n is None or n < 0:
+            raw = self.response.read()
+            self.timing["bytes"] += len(raw)
+            data = self.decode(raw) + self.flush()
+            self.finish()
+            return data
+        # A compressed chunk can decode to nothing; keep reading until it
+        # gives something or the body ends
+        while True:
+            raw = self.response.read(n)
+            if not raw:
+                data = self.flush()
+                self.finish()
+                return data
+            self.timing["bytes"] += len(raw)
+            data = self.decode(raw)
+            if data:
+                return data
+
+    def flush(self):
+        if self.decoder is not None and hasattr(self.decoder, "flush"):
+            return self.decoder.flush()
+        return b""
+
+    def finish(self):
+        self.finished = True
+        self.timing["total_ms"] = (time.perf_counter() - self.timing["start"]) * 1000
+        self.pool.release(self.key, self.conn, self.response)
+        self.pool.record(self.timing)
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def close(self):
+        if not self.finished:
+            # Body left unread: the connection can't be reused
+            self.finished = True
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _ConnectionPool:
+    # Keep-alive http.client connections, kept idle per (scheme, host, port)
+    # and reused by later requests, so they skip the TCP and TLS handshakes.
+    # Each request's timing (connect, time to first byte, total, bytes on
+    # the wire, whether the connection was reused) is kept in history.
+    max_idle = 4
+    max_redirects = 10
+    timeout = 30
+
+    def __init__(self):
+        self.idle = {}  # key -> [connection]
+        self.lock = threading.Lock()
+        self.history = deque(maxlen=256)
+
+    def request(self, url, headers=None, method="GET"):
+        timing = {"url": url, "start": time.perf_counter(), "redirects": 0, "bytes": 0}
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                return urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}))
+            key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+            path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+            send_headers = {"Accept-Encoding": ACCEPT_ENCODING, "Connection": "keep-alive"}
+            send_headers.update(headers or {})
+
+            conn, response = self.send(key, method, path, send_headers, timing)
+            location = response.getheader("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                self.release(key, conn, response)
+                url = urllib.parse.urljoin(url, location)
+                timing["redirects"] += 1
+                if response.status == 303:
+                    method = "GET"
+                continue
+
+            timing["url"] = url
+            result = HttpResponse(self, key, conn, response, url, timing)
+            if response.status >= 400:
+                body = result.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+            return result
+        raise urllib.error.URLError(f"Too many redirects: {url}")
+
+    def send(self, key, method, path, headers, timing):
+        for attempt in range(2):
+            conn, reused = self.acquire(key, timing)
+            sent = time.perf_counter()
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+                # An idle connection the server already closed: retry on a new one
+                if not reused or attempt:
+                    raise
+                continue
+            timing["ttfb_ms"] = (time.perf_counter() - sent) * 1000
+            timing["reused"] = reused
+            return conn, response
+
+    def acquire(self, key, timing):
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                timing["connect_ms"] = 0
+                return idle.pop(), True
+        scheme, host, port = key
+        started = time.perf_counter()
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        conn.connect()
+        timing["connect_ms"] = (time.perf_counter() - started) * 1000
+        return conn, False
+
+    def release(self, key, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def record(self, timing):
+        timing = dict(timing)
+        del timing["start"]
+        self.history.append(timing)
+
+    def clear(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+Connections = _ConnectionPool()
+
+
+# ================== HTTP CACHE ==================
+
+class CachedResponse:
+    # A stored response, read like the one urlopen returns
+    def __init__(self, entry):
+        self.url = entry["url"]
+        self.status = entry["status"]
+        self.headers = dict(entry["headers"])
+        self.stream = io.BytesIO(entry["body"])
+        self.fromCache = True
+
+    def read(self, n=-1):
+        return self.stream.read(n)
+
+    def getheader(self, name, default=None):
+        for key, value in self.headers.items():
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CachingResponse:
+    # Passes a network response through as it is read, and stores the body
+    # once it has been read to the end. A redirected response is stored
+    # under the URL it came from in the end, which its freshness is for.
+    def __init__(self, cache, url, response):
+        self.cache = cache
+        self.url = getattr(response, "url", None) or url
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        self.parts = []
+        self.size = 0
+        self.fromCache = False
+
+    def read(self, n=-1):
+        data = self.response.read() if n is None or n < 0 else self.response.read(n)
+        if self.parts is not None:
+            if data:
+                self.parts.append(data)
+                self.size += len(data)
+                if self.size > self.cache.max_body:
+                    self.parts = None  # too big to keep; still passed through
+            if self.parts is not None and (not data or n is None or n < 0):
+                self.cache.store(self.url, self.status, self.headers, b"".join(self.parts))
+                self.parts = None
+        return data
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _HttpCache:
+    # GET responses kept in an in-memory LRU and on disk. A stored response is
+    # reused without touching the network while fresh by Cache-Control
+    # max-age or Expires; once stale it is revalidated with If-None-Match /
+    # If-Modified-Since and a 304 reuses the stored body. Fetches run on
+    # PageLoader threads, so the stores are behind a lock.
+    max_memory = 32 * 1024 * 1024
+    max_disk = 256 * 1024 * 1024
+    max_body = 8 * 1024 * 1024
+    heuristic_limit = 24 * 60 * 60
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(os.path.expanduser("~"), ".pybrowser_cache")
+        self.memory = OrderedDict()  # url -> entry
+        self.memory_size = 0
+        self.disk_size = None
+        self.lock = threading.Lock()
+
+    def fetch(self, url, headers=None, revalidate=False):
+        # Returns a response to read the body of url from: the stored one if
+        # still fresh (and not revalidating), else the network's
+        entry = self.lookup(url)
+        if entry is not None and not revalidate and not entry["no_cache"] and entry["expires"] > time.time():
+            return CachedResponse(entry)
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            response_headers = dict((key.lower(), value) for key, value in entry["headers"])
+            if "etag" in response_headers:
+                request_headers["If-None-Match"] = response_headers["etag"]
+            if "last-modified" in response_headers:
+                request_headers["If-Modified-Since"] = response_headers["last-modified"]
+        response = Connections.request(url, request_headers)
+        if response.status == 304 and entry is not None:
+            # Still valid: refresh the stored headers' freshness and reuse it
+            response.read()
+            merged = dict(entry["headers"])
+            merged.update(response.headers.items())
+            self.store(url, entry["status"], merged, entry["body"])
+            return CachedResponse(self.lookup(url) or entry)
+        return CachingResponse(self, url, response)
+
+    # ---------- freshness ----------
+    def freshness(self, headers):
+        # (expires at, no_cache) for a response, or None if it must not be stored
+        headers = dict((key.lower(), value) for key, value in headers.items())
+        directives = {}
+        for part in headers.get("cache-control", "").lower().split(","):
+            key, _, value = part.strip().partition("=")
+            if key:
+                directives[key] = value.strip('"')
+        if "no-store" in directives:
+            return None
+        if headers.get("vary", "").strip().lower() not in ("", "accept-encoding"):
+            return None
+
+        now = time.time()
+        date = self.parseDate(headers.get("date")) or now
+        no_cache = "no-cache" in directives
+        if "max-age" in directives:
+            try:
+                age = int(headers.get("age", 0))
+                return now + int(directives["max-age"]) - age, no_cache
+            except ValueError:
+                return now, True
+        if "expires" in headers:
+            expires = self.parseDate(headers["expires"])
+            return now + (expires - date if expires else 0), no_cache
+        last_modified = self.parseDate(headers.get("last-modified"))
+        if last_modified:
+            # No explicit lifetime: a tenth of the time since it last changed
+            return now + min((date - last_modified) / 10, self.heuristic_limit), no_cache
+        if "etag" in headers:
+            return now, True
+        return None
+
+    def parseDate(self, value):
+        if not value:
+            return None
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    # ---------- storage ----------
+    def store(self, url, status, headers, body):
+        if status != 200:
+            return
+        # Bodies come decoded, so their transfer encoding no longer applies
+        headers = dict((key, value) for key, value in headers.items()
+                       if key.lower() not in ("content-encoding", "content-length", "transfer-encoding"))
+        fresh = self.freshness(headers)
+        if fresh is None:
+            self.drop(url)
+            return
+        entry = {"url": url, "status": status, "headers": list(headers.items()), "body": body,
+                 "expires": fresh[0], "no_cache": fresh[1]}
+        with self.lock:
+            self.remember(entry)
+            self.write(entry)
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.memory.get(url)
+            if entry is not None:
+                self.memory.move_to_end(url)
+                return entry
+            entry = self.read(url)
+            if entry is not None:
+                self.remember(entry)
+            return entry
+
+    def drop(self, url):
+        with self.lock:
+            entry = self.memory.pop(url, None)
+            if entry is not None:
+                self.memory_size -= len(entry["body"])
+            try:
+                os.remove(self.path(url))
+            except OSError:
+                pass
+
+    def remember(self, entry):
+        old = self.memory.pop(entry["url"], None)
+        if old is not None:
+            self.memory_size -= len(old["body"])
+        self.memory[entry["url"]] = entry
+        self.memory_size += len(entry["body"])
+        while self.memory_size > self.max_memory and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted["body"])
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".cache")
+
+    def read(self, url):
+        # Disk entries are a JSON line of metadata followed by the body
+        try:
+            with open(self.path(url), "rb") as f:
+                meta = json.loads(f.readline())
+                meta["body"] = f.read()
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get("url") == url else None
+
+    def write(self, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.disk_size is None:
+                self.disk_size = sum(os.path.getsize(os.path.join(self.directory, name))
+                                     for name in os.listdir(self.directory))
+            path = self.path(entry["url"])
+            if os.path.exists(path):
+                self.disk_size -= os.path.getsize(path)
+            meta = dict(entry)
+            del meta["body"]
+            with open(path + ".tmp", "wb") as f:
+                f.write(json.dumps(meta).encode("utf-8") + b"\n")
+                f.write(entry["body"])
+            os.replace(path + ".tmp", path)
+            self.disk_size += os.path.getsize(path)
+            if self.disk_size > self.max_disk:
+                self.prune()
+        except OSError as e:
+            print("Cache write failed:", e, type="error")
+
+    def prune(self):
+        # Least recently written entries go first
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        files.sort(key=os.path.getmtime)
+        for path in files:
+            if self.disk_size <= self.max_disk * 0.8:
+                break
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.disk_size -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_size = 0
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    os.remove(os.path.join(self.directory, name))
+            self.disk_size = 0
+
+
+HttpCache = _HttpCache()
+
+
+# ================== SUBRESOURCES ==================
+
+class _SubresourcePool:
+    # Fetches scripts, stylesheets and images for every page on a bounded
+    # set of worker threads, running at most per_host at a time for any one
+    # host so a slow server can't hold all the workers
+    workers = 6
+    per_host = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = {}  # host -> deque of (url, deliver)
+        self.active = {}  # host -> fetches running
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="subresource")
+
+    def fetch(self, url, deliver):
+        # deliver(body, error) is called on a worker thread
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if self.active.get(host, 0) >= self.per_host:
+                self.waiting.setdefault(host, deque()).append((url, deliver))
+                return
+            self.active[host] = self.active.get(host, 0) + 1
+        self.executor.submit(self.run, host, url, deliver)
+
+    def run(self, host, url, deliver):
+        try:
+            with HttpCache.fetch(url, {"User-Agent": USER_AGENT}) as response:
+                body = response.read()
+        except Exception as e:
+            deliver(None, e)
+        else:
+            deliver(body, None)
+        finally:
+            with self.lock:
+                waiting = self.waiting.get(host)
+                if waiting:
+                    job = waiting.popleft()
+                else:
+                    job = None
+                    self.active[host] -= 1
+            if job is not None:
+                self.executor.submit(self.run, host, *job)
+
+
+Subresources = _SubresourcePool()
+
+
+class PageResources:
+    # One page's subresource requests. Bodies arrive on pool threads and are
+    # handed to the page on the Tk thread by poll(): the PageLoader calls it
+    # while the page loads, and start() keeps it polling after that.
+    poll_ms = 15
+
+    def __init__(self, cssrenderer):
+        self.cssrenderer = cssrenderer
+        self.results = queue.Queue()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.started = False
+        self.cancelled = False
+        self.after_id = None
+
+    def request(self, url, handler, prepare=None):
+        # handler(body, error) runs on the Tk thread once url is fetched;
+        # prepare(body), if given, runs first on the pool thread and what it
+        # returns is handed over instead
+        if self.cancelled:
+            return
+
+        def deliver(body, error):
+            if error is None and prepare is not None:
+                try:
+                    body = prepare(body)
+                except Exception as e:
+                    body, error = None, e
+            self.results.put((handler, body, error))
+
+        with self.lock:
+            self.pending += 1
+        Subresources.fetch(url, deliver)
+        if self.started and threading.current_thread() is threading.main_thread():
+            self.schedule()
+
+    def start(self):
+        self.started = True
+        self.schedule()
+
+    def schedule(self):
+        visualSystem = self.cssrenderer.visualSystem
+        if self.after_id is None and not self.cancelled and self.pending and visualSystem is not None and visualSystem.root is not None:
+            self.after_id = visualSystem.root.after(self.poll_ms, self.tick)
+
+    def tick(self):
+        self.after_id = None
+        self.poll()
+        self.schedule()
+
+    def poll(self):
+        while not self.cancelled:
+            try:
+                handler, body, error = self.results.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                self.pending -= 1
+            with self.cssrenderer.htmlCollection.lock:
+                try:
+                    handler(body, error)
+                except Exception as e:
+                    print(e, type="error")
+
+    def cancel(self):
+        self.cancelled = True
+        if self.after_id is not None:
+            self.cssrenderer.visualSystem.root.after_cancel(self.after_id)
+            self.after_id = None
+
+
+# ================== IMAGES ==================
+
+class _ImageCache:
+    # Decoded images shared by every page, keyed by (absolute url, requested
+    # size) and evicted least recently used past max_bytes of pixels. Bytes
+    # are decoded and scaled down to the size they're shown at on the pool
+    # thread with Pillow when it's installed; without it Tk decodes them on
+    # its own thread and subsample() shrinks them.
+    max_bytes = 64 * 1024 * 1024
+    max_side = 2048  # nothing is kept bigger than this either way
+
+    def __init__(self):
+        self.images = OrderedDict()  # key -> (image, (width, height))
+        self.size = 0
+        self.lock = threading.Lock()  # looked up from the parser thread
+
+    def requestedSize(self, attrs):
+        # The <img> width and height attributes; either may be None
+        size = []
+        for name in ("width", "height"):
+            try:
+                size.append(int(attrs[name]))
+            except (KeyError, ValueError):
+                size.append(None)
+        return tuple(size)
+
+    def fit(self, natural, requested):
+        # Size to show an image of natural size at; never scaled up
+        width, height = max(natural[0], 1), max(natural[1], 1)
+        target_width, target_height = requested
+        if target_width is None and target_height is None:
+            target_width, target_height = width, height
+        elif target_width is None:
+            target_width = width * target_height / height
+        elif target_height is None:
+            target_height = height * target_width / width
+        scale = min(1, self.max_side / max(target_width, target_height, 1))
+        return (max(1, min(width, round(target_width * scale))),
+                max(1, min(height, round(target_height * scale))))
+
+    def decode(self, body, requested):
+        # Runs on a pool thread
+        if Image is None:
+            return body
+        image = Image.open(io.BytesIO(body))
+        target = self.fit(image.size, requested)
+        if target != image.size:
+            image.draft("RGB", target)  # JPEGs decode straight at a smaller scale
+        if image.mode not in ("1", "L", "RGB", "RGBA"):
+            image = image.convert("RGBA")
+        if target != image.size:
+            image = image.resize(target, Image.LANCZOS)
+        image.load()
+        return image
+
+    def photo(self, decoded, requested, visualSystem):
+        # Runs on the Tk thread
+        if ImageTk is not None:
+            return ImageTk.PhotoImage(decoded)
+        image = visualSystem.PhotoImage(data=base64.b64encode(decoded))
+        natural = (image.width(), image.height())
+        target = self.fit(natural, requested)
+        factor = max(math.ceil(natural[0] / target[0]), math.ceil(natural[1] / target[1]))
+        if factor > 1:
+            image = image.subsample(factor)
+        return image
+
+    def get(self, key):
+        with self.lock:
+            entry = self.images.get(key)
+            if entry is not None:
+                self.images.move_to_end(key)
+            return entry
+
+    def put(self, key, image):
+        size = (image.width(), image.height())
+        with self.lock:
+            old = self.images.pop(key, None)
+            if old is not None:
+                self.size -= old[1][0] * old[1][1] * 4
+            self.images[key] = (image, size)
+            self.size += size[0] * size[1] * 4
+            while self.size > self.max_bytes and len(self.images) > 1:
+                # Pages still showing an evicted image keep their own reference
+                _, (_, evicted) = self.images.popitem(last=False)
+                self.size -= evicted[0] * evicted[1] * 4
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.size = 0
+
+
+Images = _ImageCache()
+
 
 # ================== BROWSER ==================
 
-def browse(url, root = None,visualSystem = None, isHtml = False):
+def ScrollableFrame(master, visualSystem):
+    # A frame inside a scrolling canvas, for the widget backend to render into
+    outer = visualSystem.Frame(master)
+    canvas = visualSystem.Canvas(outer, highlightthickness=0)
+    scrollbar = visualSystem.Scrollbar(outer, orient="vertical", command=canvas.yview)
+    canvas.configure(yscrollcommand=scrollbar.set)
+    scrollbar.pack(side="right", fill="y")
+    canvas.pack(side="left", expand=True, fill="both")
+
+    inner = visualSystem.Frame(canvas)
+    window = canvas.create_window(0, 0, window=inner, anchor="nw")
+    inner.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
+    canvas.bind("<Configure>", lambda e: canvas.itemconfig(window, width=e.width))
+
+    # The wheel events go to the widget under the pointer, so take them
+    # app-wide while the pointer is over the page
+    def onWheel(event):
+        if event.num == 4:
+            canvas.yview_scroll(-1, "units")
+        elif event.num == 5:
+            canvas.yview_scroll(1, "units")
+        else:
+            canvas.yview_scroll(int(-event.delta / 120), "units")
+
+    def onEnter(event):
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            canvas.bind_all(sequence, onWheel)
+
+    def onLeave(event):
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            canvas.unbind_all(sequence)
+
+    canvas.bind("<Enter>", onEnter)
+    canvas.bind("<Leave>", onLeave)
+    return outer, inner
+
+
+class PageLoader:
+    # Fetches and parses a page on a worker thread a chunk at a time, while
+    # the Tk thread polls a queue and paints whatever has been parsed, so
+    # the window stays responsive and the page shows as it downloads. The
+    # collection lock keeps the parser and the painter apart. Scripts are
+    # deferred by the parser and run by the painter when it reaches them.
+    chunk_size = 16384
+    poll_ms = 10
+
+    def __init__(self, open_response, cssrenderer, content_frame, visualSystem):
+        self.open_response = open_response
+        self.cssrenderer = cssrenderer
+        self.content_frame = content_frame
+        self.visualSystem = visualSystem
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.held = ""
+        self.touched = set()  # elements that were open while a chunk was parsed
+        self.painted = 0
+        self.inline_container = None
+        self.shownText = {}  # open element -> text it was painted with
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+        self.after_id = None
+        self.done = False
+        self.blocked = False  # painting waits on a script or stylesheet
+        self.error = None
+
+        cssrenderer.loader = self
+        cssrenderer.deferScripts = True
+        if visualSystem.backend == "canvas":
+            RenderCanvas(cssrenderer, content_frame, visualSystem).layout.limit = 0
+        elif visualSystem.backend == "headless":
+            RenderHeadless(cssrenderer, visualSystem).layout.limit = 0
+        else:
+            cssrenderer.content_frame = content_frame
+            cssrenderer.patch_frames.clear()
+
+    def start(self):
+        threading.Thread(target=self.fetch, daemon=True).start()
+        self.after_id = self.visualSystem.root.after(self.poll_ms, self.poll)
+
+    # ---------- worker thread ----------
+    def fetch(self):
+        try:
+            with self.open_response() as response:
+                while not self.cancelled.is_set():
+                    data = response.read(self.chunk_size)
+                    with self.cssrenderer.htmlCollection.lock:
+                        if self.cancelled.is_set():
+                            return
+                        self.parse(data)
+                    self.messages.put("chunk" if data else "done")
+                    if not data:
+                        return
+        except Exception as e:
+            self.messages.put(e)
+
+    def parse(self, data):
+        cssrenderer = self.cssrenderer
+        # Only elements open while a chunk is parsed can have text added to them
+        self.touched.update(entry[3] for entry in cssrenderer.tag_stack)
+        if data:
+            # The parser strips each piece of text it is handed, so only
+            # feed up to the last tag and keep text runs in one piece
+            text = self.held + self.decoder.decode(data)
+            cut = max(text.rfind("<"), 0)
+            self.held = text[cut:]
+            cssrenderer.feed(text[:cut])
+        else:
+            cssrenderer.feed(self.held + self.decoder.decode(b"", final=True))
+            cssrenderer.close()
+
+    # ---------- Tk thread ----------
+    def poll(self):
+        self.after_id = None
+        if self.cancelled.is_set():
+            return
+        received = False
+        error = None
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            received = True
+            if message == "done":
+                self.done = True
+            elif isinstance(message, Exception):
+                error = message
+
+        # Scripts and stylesheets painting waits on may have come in
+        self.cssrenderer.resources.poll()
+        if received or self.blocked:
+            with self.cssrenderer.htmlCollection.lock:
+                try:
+                    self.paint(self.done or error is not None)
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            self.error = error
+            print(error, type="error")
+            self.visualSystem.Label(self.content_frame, text=f"Error: {error}", fg="red").pack(anchor="w")
+        if error is not None or (self.done and not self.blocked):
+            self.finish()
+        else:
+            self.after_id = self.visualSystem.root.after(self.poll_ms, self.poll)
+
+    def paint(self, done):
+        cssrenderer = self.cssrenderer
+        elements = cssrenderer.htmlCollection.elements
+        view = cssrenderer.canvasView
+
+        touched, self.touched = self.touched, set()
+        for element in touched:
+            if not element.data.get("content"):
+                continue
+            content = ResolveTextStyle(cssrenderer, element)[0]
+            if self.shownText.get(element) == content:
+                continue
+            self.shownText[element] = content
+            if view is not None:
+                view.layout.setText(element, content)
+            elif element.boundObject is not None:
+                element.boundObject.configure(text=content)
+        self.shownText = {entry[3]: self.shownText.get(entry[3]) for entry in cssrenderer.tag_stack}
+
+        # Hold back from the innermost open element if its text has not
+        # arrived yet, as it would not be drawn at all without any
+        end = len(elements)
+        if not done and cssrenderer.tag_stack:
+            top = cssrenderer.tag_stack[-1][3]
+            if not top.data.get("content"):
+                for index in range(len(elements) - 1, self.painted - 1, -1):
+                    if elements[index] is top:
+                        end = index
+                        break
+
+        start = index = self.painted
+        self.blocked = False
+        while index < end:
+            element = elements[index]
+            if (element.type == "script" and element.data.get("code") is None) or \
+                    (element.type == "link" and not element.data.get("loaded")):
+                # Nothing after it can be run or styled until it arrives
+                end = index
+                self.blocked = True
+                break
+            index += 1
+            if element.type != "script":
+                continue
+            self.render(elements[start:index - 1])
+            count = len(elements)
+            cssrenderer.runScript(element, index - 1)
+            # document.write output lands right after the script
+            end += len(elements) - count
+            start = index
+        self.render(elements[start:end])
+        self.painted = end
+
+        if view is not None:
+            view.layout.limit = end
+            view.refresh()
+
+    def render(self, elements):
+        if elements and self.cssrenderer.canvasView is None:
+            self.inline_container = RenderCSS(self.cssrenderer, self.content_frame, self.visualSystem,
+                                              elements, self.inline_container)
+
+    def finish(self):
+        cssrenderer = self.cssrenderer
+        cssrenderer.deferScripts = False
+        if cssrenderer.loader is self:
+            cssrenderer.loader = None
+        if cssrenderer.canvasView is not None:
+            cssrenderer.canvasView.layout.limit = None
+            cssrenderer.canvasView.refresh()
+        # Images still on their way are handed over from here on
+        cssrenderer.resources.start()
+
+    def cancel(self):
+        # A newer navigation took over; the thread stops at its next chunk
+        self.cancelled.set()
+        if self.after_id is not None:
+            self.visualSystem.root.after_cancel(self.after_id)
+            self.after_id = None
+        self.cssrenderer.deferScripts = False
+        if self.cssrenderer.loader is self:
+            self.cssrenderer.loader = None
+
+
+def leavePage(visualSystem, keep=True):
+    # Puts the current page in the back/forward cache if it finished loading
+    # as a history entry, otherwise stops its timers and handlers
+    page = visualSystem.page
+    if page is None:
+        return
+    visualSystem.page = None
+    if keep and page.loader is None and page.historyIndex is not None and page.page_frame is not None:
+        searchHistory.cache.store(page.historyIndex, page, visualSystem)
+        return
+    page.teardown()
+
+
+def restorePage(page, objects, root, visualSystem):
+    # Shows a page from the back/forward cache as it was left
+    leavePage(visualSystem)
+    visualSystem.clear()
+    createSearchBar(root, page.url, visualSystem)
+    root.title("Python Mini Browser")
+    for element in page.htmlCollection.getElementsByTagName("title"):
+        if element.data.get("content"):
+            root.title(element.data["content"])
+    visualSystem.attach(objects)
+    page.page_frame.pack(expand=True, fill="both")
+    visualSystem.page = page
+    page.js.resume()
+
+
+def browse(url, root = None,visualSystem = None, isHtml = False, reload = False, historyIndex = None):
     if root is None:
         root = tk.Tk()
     if visualSystem is None:
         visualSystem = VISUALSYSTEM(root)
 
-    # Clear previous content
+    # A reload stays the same history entry
+    if reload and historyIndex is None and visualSystem.page is not None:
+        historyIndex = visualSystem.page.historyIndex
+
+    # Keep or stop the previous page, then clear its content
+    leavePage(visualSystem, keep=not reload)
     visualSystem.clear()
 
     createSearchBar(root,url,visualSystem)
 
     root.title("Python Mini Browser")
 
-    content_frame = visualSystem.Frame(root)
-    content_frame.pack(expand=True, fill="both")
+    if visualSystem.backend == "canvas":
+        # CanvasView scrolls, and only draws what is in view, by itself
+        page_frame = content_frame = visualSystem.Frame(root)
+    else:
+        page_frame, content_frame = ScrollableFrame(root, visualSystem)
+    page_frame.pack(expand=True, fill="both")
 
     try:
+        cssrenderer = AdvancedCSSRenderer(visualSystem)
+        visualSystem.page = cssrenderer
+        cssrenderer.page_frame = page_frame
+        cssrenderer.historyIndex = historyIndex
+
         if not isHtml:
-            req = urllib.request.Request(url)
-            req.add_header("User-Agent","Spifftech/1.0 PyBrowser/1")
-            with urllib.request.urlopen(req) as r:
-                html = r.read().decode("utf-8", errors="ignore")
-        else:
-            html = url
+            headers = {"User-Agent": USER_AGENT}
+            cssrenderer.url = url
+            # Fetched (through the cache) and parsed off the Tk thread,
+            # painted as it arrives. A reload revalidates a cached copy.
+            PageLoader(lambda: HttpCache.fetch(url, headers, revalidate=reload), cssrenderer, content_frame, visualSystem).start()
+            return
 
-        cssrenderer = AdvancedCSSRenderer(visualSystem)
-        cssrenderer.feed(html)
+        cssrenderer.feed(url)
 
         #====== Renderer Start ======
 
-        RenderCSS(cssrenderer, content_frame,visualSystem)
+        if visualSystem.backend == "canvas":
+            RenderCanvas(cssrenderer, content_frame, visualSystem)
+        else:
+            RenderCSS(cssrenderer, content_frame,visualSystem)
+        cssrenderer.resources.start()
 
         #==== Renderer End ====
 
@@ -997,14 +4517,66 @@ def browse(url, root = None,visualSystem = None, isHtml = False):
         raise e
 
 
+class BackForwardCache:
+    # Whole pages left by navigating away, keyed by their SearchStack index:
+    # the parsed document, CSS, JS state and their detached widgets. Going
+    # back or forward to one just packs it again and resumes its timers.
+    # Bounded by page count and by a rough estimate of the memory they hold.
+    max_pages = 4
+    max_bytes = 64 * 1024 * 1024
+
+    def __init__(self):
+        self.pages = OrderedDict()  # history index -> (page, widgets, size)
+        self.size = 0
+
+    def store(self, index, page, visualSystem):
+        page.js.pause()
+        page.page_frame.pack_forget()
+        objects = visualSystem.detach(page.page_frame)
+        size = self.estimate(page, objects)
+        self.discard(index)
+        self.pages[index] = (page, objects, size)
+        self.size += size
+        while self.pages and (len(self.pages) > self.max_pages or self.size > self.max_bytes):
+            self.discard(next(iter(self.pages)))
+
+    def take(self, index):
+        entry = self.pages.pop(index, None)
+        if entry is None:
+            return None
+        self.size -= entry[2]
+        return entry
+
+    def discard(self, index):
+        entry = self.take(index)
+        if entry is not None:
+            page = entry[0]
+            page.teardown()
+            page.page_frame.destroy()
+
+    def discardFrom(self, index):
+        for key in [key for key in self.pages if key >= index]:
+            self.discard(key)
+
+    def estimate(self, page, objects):
+        # Bytes per element and widget are ballpark figures for the Python
+        # and Tk objects behind them
+        size = len(objects) * 2048
+        for element in page.htmlCollection.elements:
+            size += 512 + len(element.data.get("content") or "")
+        return size
+
+
 class SearchStack:
     def __init__(self):
         self.stack = []
         self.index = -1
+        self.cache = BackForwardCache()
 
     def push(self, item):
         if self.index < len(self.stack) - 1:
             self.stack = self.stack[:self.index+1]
+            self.cache.discardFrom(self.index + 1)
         self.stack.append(item)
         self.index += 1
 
@@ -1043,21 +4615,32 @@ def createAbsoluteURL(url, givenUrl):
         return url + "/" + givenUrl
 
 
+def showHistoryEntry(url, root, visualSystem):
+    index = searchHistory.index
+    page = visualSystem.page
+    if page is not None and page.historyIndex == index:
+        return  # already at the end of the history
+    cached = searchHistory.cache.take(index)
+    if cached is not None:
+        restorePage(cached[0], cached[1], root, visualSystem)
+    else:
+        browse(url, root, visualSystem, historyIndex=index)
+
 def previousSearch(root,visualSystem):
     print(searchHistory.stack)
     url = searchHistory.back()
     if url:
-        browse(url,root,visualSystem)
+        showHistoryEntry(url, root, visualSystem)
 def nextSearch(root,visualSystem):
     print(searchHistory.stack)
     url = searchHistory.forward()
     if url:
-        browse(url,root,visualSystem)
+        showHistoryEntry(url, root, visualSystem)
 def searchAndStack(url,root,visualSystem):
 
     searchHistory.push(url)
     print(searchHistory.stack)
-    browse(url,root,visualSystem)
+    browse(url,root,visualSystem,historyIndex=searchHistory.index)
 
 def createSearchBar(root,url = "",visualSystem = None):
     top_frame = visualSystem.Frame(root)
@@ -1068,7 +4651,7 @@ def createSearchBar(root,url = "",visualSystem = None):
     backButton.pack(in_=top_frame, side="left")
     backButton = visualSystem.Button(text=">",command=lambda: nextSearch(root,visualSystem))
     backButton.pack(in_=top_frame, side="left")
-    refreshButton = visualSystem.Button(text="Refresh",command=lambda: browse(url,root,visualSystem))
+    refreshButton = visualSystem.Button(text="Refresh",command=lambda: browse(url,root,visualSystem,reload=True))
     refreshButton.pack(in_=top_frame, side="left")
     urlSelect.delete(0, tk.END)
     urlSelect.insert(0,url)
@@ -1092,9 +4675,260 @@ class BuiltinSites():
 
 
 
+# ================== HEADLESS ==================
+
+class HeadlessRoot:
+    # Stands in for the Tk root where there is no display. after() calls
+    # are kept in a heap and run by pump() on the calling thread, so the
+    # PageLoader, subresources and JS timers work as they do under Tk.
+    def __init__(self):
+        self.calls = []  # heap of (due, id, func, args)
+        self.cancelled = set()
+        self.next_id = 1
+        self.titleText = ""
+
+    def after(self, ms, func, *args):
+        call_id = self.next_id
+        self.next_id += 1
+        heapq.heappush(self.calls, (time.monotonic() + ms / 1000, call_id, func, args))
+        return call_id
+
+    def after_cancel(self, call_id):
+        self.cancelled.add(call_id)
+
+    def pump(self, until, done=None):
+        # Runs callbacks as they fall due until the monotonic time until, or
+        # sooner once done() holds; returns whether it did
+        while not (done is not None and done()):
+            while self.calls and self.calls[0][1] in self.cancelled:
+                self.cancelled.discard(heapq.heappop(self.calls)[1])
+            if not self.calls or self.calls[0][0] > until:
+                if done is None:
+                    return False
+                # Waiting on another thread (a fetch) with nothing due yet
+                wait = min(until, self.calls[0][0] if self.calls else until) - time.monotonic()
+                if wait <= 0:
+                    return False
+                time.sleep(min(wait, 0.005))
+                continue
+            due, _, func, args = heapq.heappop(self.calls)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            func(*args)
+        return True
+
+    def title(self, text=None):
+        if text is None:
+            return self.titleText
+        self.titleText = text
+
+    def bind(self, *args):
+        return None
+
+    def unbind(self, *args):
+        pass
+
+    def focus_set(self):
+        pass
+
+
+class NullWidget:
+    # Takes the calls the renderers make on Tk widgets and draws nothing
+    def __init__(self, master=None, **kwargs):
+        self.master = master
+        self.children = []
+        if isinstance(master, NullWidget):
+            master.children.append(self)
+
+    def pack(self, **kwargs):
+        pass
+
+    def pack_forget(self):
+        pass
+
+    def config(self, **kwargs):
+        pass
+
+    configure = config
+
+    def cget(self, key):
+        return ""
+
+    def bind(self, *args):
+        return None
+
+    def winfo_children(self):
+        return list(self.children)
+
+    def winfo_exists(self):
+        return True
+
+    def destroy(self):
+        if isinstance(self.master, NullWidget) and self in self.master.children:
+            self.master.children.remove(self)
+
+
+class NullVisualSystem(VISUALSYSTEM):
+    # The "headless" backend: pages are parsed, styled, run and laid out at
+    # width with ApproxMetrics by a HeadlessView, with no widgets or images
+    images = False
+
+    def __init__(self, root=None, width=800):
+        super().__init__(root if root is not None else HeadlessRoot(), backend="headless")
+        self.width = width
+
+    def Button(self, *args, **kwargs):
+        return self._create(NullWidget, *args, **kwargs)
+
+    Entry = Label = TransparentLabel = Frame = Canvas = Scrollbar = Button
+
+    def Alert(self, message):
+        # Only logged: no dialog to wait on, and no display to show one
+        print("JS:", message)
+
+
+class HeadlessView:
+    # Takes a CanvasView's place for the headless backend: keeps the page's
+    # DocumentLayout current with loading and script text changes, drawing
+    # nothing. Laid out elements get a CanvasRun as their boundObject so
+    # script text updates reach the layout.
+    def __init__(self, cssrenderer, width):
+        self.cssrenderer = cssrenderer
+        self.width = width
+        self.layout = DocumentLayout(cssrenderer, ApproxMetrics())
+        self.flowed = None
+        self.bound = 0  # boxes of flowed given boundObjects so far
+
+    def refresh(self):
+        layout = self.layout.flow(self.width)
+        if layout is not self.flowed:
+            self.flowed = layout
+            self.bound = 0
+        for box in layout.boxes[self.bound:]:
+            if box.item.element.boundObject is None:
+                box.item.element.boundObject = CanvasRun(self, box.item.element)
+        self.bound = len(layout.boxes)
+        return layout
+
+    render = reflow = refresh
+
+    def setText(self, element, text):
+        self.layout.setText(element, text)
+
+    def imageLoaded(self, element):
+        self.layout.remeasure(element)
+
+    def patch(self, removed, new_elements):
+        self.layout.forget(removed)
+
+
+def RenderHeadless(cssrenderer, visualSystem):
+    view = HeadlessView(cssrenderer, visualSystem.width)
+    cssrenderer.canvasView = view  # everything that updates a CanvasView's layout updates this one's
+    view.refresh()
+    return view
+
+
+def HeadlessRender(source, width=800, run_ms=0, timeout=30):
+    # Loads a URL or HTML file through the normal pipeline without a display
+    # and reports its text, layout and timings as a JSON-able dict
+    result = {"source": source}
+    Console.echo = False
+    logged = len(Console.log)
+    started = time.perf_counter()
+    visualSystem = NullVisualSystem(width=width)
+    root = visualSystem.root
+    cssrenderer = AdvancedCSSRenderer(visualSystem)
+    visualSystem.page = cssrenderer
+    try:
+        if os.path.exists(source):
+            path = os.path.abspath(source)
+            cssrenderer.url = "file://" + urllib.request.pathname2url(path)
+            open_response = lambda: open(path, "rb")
+        else:
+            cssrenderer.url = source
+            open_response = lambda: HttpCache.fetch(source, {"User-Agent": USER_AGENT})
+        loader = PageLoader(open_response, cssrenderer, None, visualSystem)
+        loader.start()
+        loaded = root.pump(time.monotonic() + timeout,
+                           lambda: cssrenderer.loader is None and not cssrenderer.resources.pending)
+        result["timed_out"] = not loaded
+        if loader.error is not None:
+            raise loader.error
+        load_done = time.perf_counter()
+        if run_ms:
+            # Lets timers and animation frames run, e.g. for a game loop
+            root.pump(time.monotonic() + run_ms / 1000)
+        run_done = time.perf_counter()
+
+        # Kept current through loading and script text changes, so only
+        # what's left to flow is laid out here
+        layout = cssrenderer.canvasView.refresh()
+        layout_done = time.perf_counter()
+
+        titles = [element.data["content"] for element in cssrenderer.htmlCollection.getElementsByTagName("title")
+                  if element.data.get("content")]
+        result["title"] = titles[0] if titles else ""
+        result["text"] = "\n".join(" ".join(box.text.strip() for box in line.boxes if box.text) for line in layout.lines)
+        result["layout"] = {
+            "width": layout.width,
+            "height": layout.height,
+            "boxes": [{"tag": box.item.element.type, "kind": box.item.kind, "text": box.text,
+                       "x": box.x, "y": box.y, "width": box.width, "height": box.height} for box in layout.boxes],
+        }
+        result["elements"] = len(cssrenderer.htmlCollection.elements)
+        result["timing"] = {
+            "load_ms": round((load_done - started) * 1000, 2),
+            "run_ms": round((run_done - load_done) * 1000, 2),
+            "layout_ms": round((layout_done - run_done) * 1000, 2),
+            "total_ms": round((layout_done - started) * 1000, 2),
+        }
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if cssrenderer.loader is not None:
+            cssrenderer.loader.cancel()
+        cssrenderer.teardown()
+        result["console"] = [[entry.type, entry.text] for entry in Console.log[logged:]]
+        del Console.log[logged:]
+    return result
+
+
+def HeadlessMain(argv):
+    # python main.py --headless [options] URL-or-file...
+    # Writes one JSON object per page to stdout, in the order given
+    parser = argparse.ArgumentParser(prog="main.py --headless", description="Render pages without a display")
+    parser.add_argument("sources", nargs="+", help="URLs or HTML files")
+    parser.add_argument("--width", type=int, default=800, help="layout width in pixels")
+    parser.add_argument("--run-ms", type=int, default=0, help="how long to let page timers run after loading")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for a page to load")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--text", action="store_true", help="write only each page's text and timings")
+    args = parser.parse_args([arg for arg in argv if arg != "--headless"])
+
+    jobs = max(1, min(args.jobs, len(args.sources)))
+    work = [(source, args.width, args.run_ms, args.timeout) for source in args.sources]
+    failed = False
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result in pool.map(HeadlessRender, *zip(*work)):
+            failed = failed or "error" in result
+            if args.text:
+                sys.stdout.write(f"==> {result['source']} {json.dumps(result.get('timing', result.get('error')))}\n")
+                sys.stdout.write(result.get("text", "") + "\n")
+            else:
+                sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+    return 1 if failed else 0
+
+
 # ================== ENTRY ==================
 
 if __name__ == "__main__":
+    # --headless renders pages given on the command line without Tk
+    if "--headless" in sys.argv:
+        sys.exit(HeadlessMain(sys.argv[1:]))
+
     #browse(exampleHtml,isHtml=True)
 
     searchHistory = SearchStack()
@@ -1104,7 +4938,8 @@ if __name__ == "__main__":
     GetBasisURL("https://femboycodedev.github.io/htmlTest.github.io/linkTest")
     root = tk.Tk()
 
-    visualSystem = VISUALSYSTEM(root)
+    # --canvas draws pages on a single canvas instead of a widget per node
+    visualSystem = VISUALSYSTEM(root, backend="canvas" if "--canvas" in sys.argv else "widgets")
 
     createSearchBar(root,visualSystem = visualSystem)
 
@@ -0,0 +1,75 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeResponse:
+    def __init__(self, body, url=None, headers=None):
+        self.body = body
+        self.offset = 0
+        self.status = 200
+        self.headers = headers or {"Cache-Control": "max-age=600"}
+        if url is not None:
+            self.url = url
+
+    def read(self, n=-1):
+        end = len(self.body) if n is None or n < 0 else self.offset + n
+        data = self.body[self.offset:end]
+        self.offset += len(data)
+        return data
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def close(self):
+        pass
+
+
+class CachingResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = main._HttpCache(self.directory.name)
+        self.cache.max_body = 1024
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_stores_body_read_in_full(self):
+        response = main.CachingResponse(self.cache, "http://example.com/a.css", FakeResponse(b"p { color: red }"))
+        self.assertEqual(response.read(), b"p { color: red }")
+        self.assertEqual(self.cache.lookup("http://example.com/a.css")["body"], b"p { color: red }")
+
+    def test_body_over_max_body_read_in_full(self):
+        body = b"x" * (self.cache.max_body + 1)
+        response = main.CachingResponse(self.cache, "http://example.com/big.png", FakeResponse(body))
+        self.assertEqual(response.read(), body)
+        self.assertIsNone(self.cache.lookup("http://example.com/big.png"))
+
+    def test_body_over_max_body_read_in_chunks(self):
+        body = b"x" * (self.cache.max_body * 3)
+        response = main.CachingResponse(self.cache, "http://example.com/big.js", FakeResponse(body))
+        chunks = []
+        while True:
+            data = response.read(500)
+            if not data:
+                break
+            chunks.append(data)
+        self.assertEqual(b"".join(chunks), body)
+        self.assertIsNone(self.cache.lookup("http://example.com/big.js"))
+
+    def test_redirect_stored_under_final_url(self):
+        source = "http://example.com/old"
+        target = "http://example.com/new"
+        response = main.CachingResponse(self.cache, source, FakeResponse(b"moved", url=target))
+        response.read()
+        self.assertIsNone(self.cache.lookup(source))
+        self.assertEqual(self.cache.lookup(target)["body"], b"moved")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class OuterHTMLStyleTest(unittest.TestCase):
+    def setUp(self):
+        main.Console.echo = False
+
+    def render(self, html):
+        renderer = main.AdvancedCSSRenderer(None)
+        renderer.feed(html)
+        renderer.close()
+        return renderer
+
+    def test_replacement_keeps_descendant_rules(self):
+        renderer = self.render('<style>.x p { color: red }</style><div class="x"><p id="t">a</p></div>'
+                               '<script>document.getElementById("t").outerHTML = "<p id=\'t\'>b</p>";</script>')
+        element = renderer.htmlCollection.getElementById("t")
+        self.assertEqual(element.data["content"], "b")
+        self.assertEqual(element.tags[-1].get("foreground"), "red")
+
+    def test_replacement_keeps_child_rules(self):
+        renderer = self.render('<style>.x > p { color: blue }</style><div class="x"><p id="t">a</p></div>'
+                               '<script>document.getElementById("t").outerHTML = "<p id=\'t\'>b</p>";</script>')
+        self.assertEqual(renderer.htmlCollection.getElementById("t").tags[-1].get("foreground"), "blue")
+
+    def test_replacement_inherits_parent_style(self):
+        renderer = self.render('<style>div { color: green }</style><div><p id="t">a</p></div>'
+                               '<script>document.getElementById("t").outerHTML = "<p id=\'t\'>b</p>";</script>')
+        self.assertEqual(renderer.htmlCollection.getElementById("t").tags[-1].get("foreground"), "green")
+
+
+if __name__ == "__main__":
+    unittest.main()